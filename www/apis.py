@@ -5,7 +5,7 @@
 JSON API definition.
 '''
 
-import json, logging, inspect, functools
+import json, logging, inspect, functools, base64
 
 class APIError(Exception):
     '''
@@ -43,6 +43,9 @@ class Page(object):
     Page object for display pages.
     '''
 
+    # 返回给前端的字段，按这个顺序编码为JSON，见encoders
+    __json_fields__ = ('item_count', 'page_count', 'page_index', 'page_size', 'offset', 'limit', 'has_next', 'has_previous')
+
     def __init__(self, item_count, page_index=1, page_size=10):
         '''
         Init Pagination by item_count, page_index and page_size.
@@ -82,7 +85,100 @@ class Page(object):
         self.has_next = self.page_index < self.page_count
         self.has_previous = self.page_index > 1
 
+    @staticmethod
+    def slice(page_index, page_size=10):
+        '''
+        Return (offset, limit) of page_index assuming the page exists,
+        so items can be fetched together with item_count.
+        >>> Page.slice(3)
+        (20, 10)
+        '''
+        return (page_size * (page_index - 1), page_size)
+
     def __str__(self):
         return 'item_count: %s, page_count: %s, page_index: %s, page_size: %s, offset: %s, limit: %s' % (self.item_count, self.page_count, self.page_index, self.page_size, self.offset, self.limit)
 
-    __repr__ = __str__
\ No newline at end of file
+    __repr__ = __str__
+
+class CursorPage(object):
+    '''
+    Page object for keyset (seek) pagination by cursor.
+    '''
+
+    __json_fields__ = ('page_size', 'cursor', 'key', 'after', 'limit', 'next_cursor', 'has_next', 'has_previous')
+
+    def __init__(self, cursor='', page_size=10, key=('created_at', 'id')):
+        '''
+        Init Pagination by cursor returned from previous page, page_size and the (order field, primary key) names.
+        >>> p1 = CursorPage()
+        >>> p1.after
+        ()
+        >>> p1.limit
+        11
+        >>> p1 = CursorPage('', 2)
+        >>> items = p1.paginate([dict(created_at=3.0, id='c'), dict(created_at=2.0, id='b'), dict(created_at=1.0, id='a')])
+        >>> len(items), p1.has_next
+        (2, True)
+        >>> p2 = CursorPage(p1.next_cursor, 2)
+        >>> p2.after
+        (2.0, 'b')
+        >>> items = p2.paginate([dict(created_at=1.0, id='a')])
+        >>> len(items), p2.has_next, p2.next_cursor
+        (1, False, '')
+        >>> CursorPage('bad')
+        Traceback (most recent call last):
+          ...
+        apis.APIValueError: Invalid cursor.
+        '''
+        self.page_size = page_size
+        self.cursor = cursor or ''
+        self.key = key
+        self.after = decode_cursor(self.cursor) if self.cursor else ()
+        # 多取一条用来判断是否还有下一页
+        self.limit = page_size + 1
+        self.next_cursor = ''
+        self.has_next = False
+        self.has_previous = bool(self.cursor)
+
+    def paginate(self, items):
+        '''
+        Trim items fetched with limit and set next_cursor from the last item of the page.
+        '''
+        items = list(items)
+        self.has_next = len(items) > self.page_size
+        items = items[:self.page_size]
+        if self.has_next:
+            last = items[-1]
+            self.next_cursor = encode_cursor(last[self.key[0]], last[self.key[1]])
+        return items
+
+    def __str__(self):
+        return 'cursor: %s, next_cursor: %s, page_size: %s, has_next: %s' % (self.cursor, self.next_cursor, self.page_size, self.has_next)
+
+    __repr__ = __str__
+
+def encode_cursor(value, pk):
+    '''
+    Encode (order field value, primary key) as an opaque url safe cursor.
+    '''
+    return base64.urlsafe_b64encode(json.dumps([value, pk]).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    '''
+    Decode cursor to (order field value, primary key), raise APIValueError if cursor is invalid.
+    The value must be a number or string and the primary key a string, as they become SQL arguments.
+    >>> decode_cursor(encode_cursor(1.5, 'a'))
+    (1.5, 'a')
+    >>> decode_cursor(encode_cursor({'a': 1}, 'x'))
+    Traceback (most recent call last):
+      ...
+    apis.APIValueError: Invalid cursor.
+    '''
+    try:
+        value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError, UnicodeError):
+        raise APIValueError('cursor', 'Invalid cursor.')
+    # bool是int的子类，也要排除
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)) or not isinstance(pk, str):
+        raise APIValueError('cursor', 'Invalid cursor.')
+    return (value, pk)
@@ -2,18 +2,24 @@
 # -*- coding: utf-8 -*-
 
 import logging
-# 指定logging记录信息的级别level为INFO
-# 级别关系：CRITICAL > ERROR > WARNING > INFO > DEBUG > NOTSET
-logging.basicConfig(level=logging.INFO)
+import logs
+from config import configs
+# 按配置设置logging的级别，级别关系：CRITICAL > ERROR > WARNING > INFO > DEBUG > NOTSET
+# 日志记录经队列交给后台线程格式化和输出，事件循环里不做stdout I/O
+logs.setup(**configs.logging)
 
-import asyncio, os, json, time
+import asyncio, os, time, hashlib, signal
 from datetime import datetime
 from aiohttp import web
 from jinja2 import Environment, FileSystemLoader
 
-import orm
+import orm, encoders
 from coroweb import add_routes, add_static
-from handlers import cookie2user, COOKIE_NAME
+from handlers import cookie2user, COOKIE_NAME, text2html
+
+import markdown2
+
+_logger = logs.get_logger('request')
 
 def index(request):
     # 不加content_type的话打开链接会直接下载
@@ -54,10 +60,22 @@ def init_jinja2(app, **kw):
 # 在处理请求前记录日志
 async def logger_factory(app, handler):
     async def logger(request):
-        logging.info('Request: %s %s' % (request.method, request.path))
-        return (await handler(request))
+        # 请求开始时决定是否被采样，本次请求内各处的日志保持一致
+        token = logs.begin_request()
+        try:
+            _logger.info('Request', method=request.method, path=request.path)
+            return (await handler(request))
+        finally:
+            logs.end_request(token)
     return logger
 
+# 为每个请求安装一个identity map，请求内重复的Model.find直接命中内存，请求结束后丢弃
+async def identity_factory(app, handler):
+    async def identity(request):
+        with orm.identity_map():
+            return (await handler(request))
+    return identity
+
 # 解析POST请求的数据
 async def data_factory(app, handler):
     async def parse_data(request):
@@ -65,33 +83,72 @@ async def data_factory(app, handler):
             if request.content_type.startswith('application/json'):
                 # 将消息主体存入请求的__data__属性
                 request.__data__ = await request.json()
-                logging.info('request json: %s' % str(request.__data__))
+                _logger.info('request json: %s', request.__data__)
             elif request.content_type.startswith('application/x-www-form-urlencoded'):
                 request.__data__ = await request.post()
-                logging.info('request form: %s' % str(request.__data__))
+                _logger.info('request form: %s', request.__data__)
         return (await handler(request))
     return parse_data
 
 # 解析cookie，并将登录用户绑定到request对象上。这样，后续的URL处理函数就可以直接拿到登录用户
 async def auth_factory(app, handler):
     async def auth(request):
-        logging.info('check user: %s %s' % (request.method, request.path))
+        _logger.debug('check user', method=request.method, path=request.path)
         request.__user__ = None
         cookie_str = request.cookies.get(COOKIE_NAME)
         if cookie_str:
             user = await cookie2user(cookie_str)
             if user:
-                logging.info('set current user: %s' % user.email)
+                _logger.info('set current user', email=user.email)
                 request.__user__ = user
         if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
             return web.HTTPFound('/signin')
-        return (await handler(request))
+        # 登录用户写入后的短时间内，后续请求的读也发往主库；未登录时只在本次请求内有效
+        with orm.session(request.__user__.id if request.__user__ else None):
+            return (await handler(request))
     return auth
 
+# ETag为响应内容的SHA1，是强ETag；由handler给出的版本算出时，相同版本渲染出的内容仍可能不同（如相对时间），是弱ETag
+def _etag(data, weak=False):
+    return '%s"%s"' % ('W/' if weak else '', hashlib.sha1(data).hexdigest())
+
+# 客户端缓存的版本是否仍然有效：有If-None-Match时只比较ETag，没有时才按If-Modified-Since比较修改时间
+def _not_modified(request, etag, last_modified):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        if if_none_match.strip() == '*':
+            return True
+        opaque = etag[2:] if etag is not None and etag.startswith('W/') else etag
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            # GET按弱比较，两边都忽略W/前缀
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag == opaque:
+                return True
+        return False
+    if last_modified is not None:
+        since = request.if_modified_since
+        # Last-Modified只精确到秒
+        return since is not None and int(last_modified) <= since.timestamp()
+    return False
+
+def _set_validators(resp, etag, last_modified):
+    if etag is not None:
+        resp.headers['ETag'] = etag
+    if last_modified is not None:
+        # 与_not_modified()一致按整秒截断
+        resp.last_modified = int(last_modified)
+    return resp
+
 # 将handler的返回值转换为web.Response对象，返回给客户端
+# 返回dict时可以带两个可选的键：
+#   __version__        代表响应内容的版本（任意能编码为JSON的值，如版本号、页面依赖的行），内容变化时它必须变化；
+#                      弱ETag由它算出，客户端缓存有效时不用渲染就返回304，没有时对渲染出的响应体计算ETag
+#   __last_modified__  内容最后修改的时间戳，用于Last-Modified和If-Modified-Since
 async def response_factory(app, handler):
     async def response(request):
-        logging.info('Response handler...')
+        _logger.debug('Response handler...')
         # 调用handler来处理URL请求，并返回结果
         r = await handler(request)
         # 若是StreamResponse，是aiohttp定义response的基类，即所有响应类型都继承自该类，直接返回
@@ -115,14 +172,41 @@ async def response_factory(app, handler):
         # 若是dict，则获取它的模板属性（jinja2的env）
         if isinstance(r, dict):
             template = r.get('__template__')
+            version = r.pop('__version__', None)
+            last_modified = r.pop('__last_modified__', None)
+            # 只有GET和HEAD是条件请求
+            conditional = request.method in ('GET', 'HEAD')
+            etag = None
+            if conditional and version is not None:
+                etag = _etag(encoders.dumps([template, version]), weak=True)
+                if _not_modified(request, etag, last_modified):
+                    return _set_validators(web.Response(status=304), etag, last_modified)
             # 若不存在对应模板，则将字典调整为json格式返回,并设置响应类型为json
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                # 含有很长列表的结果分块编码、分块发送，不在内存里拼出整个响应，只有handler给出版本时才有ETag
+                if encoders.is_large(r):
+                    resp = web.StreamResponse()
+                    resp.content_type = 'application/json'
+                    resp.charset = 'utf-8'
+                    _set_validators(resp, etag, last_modified)
+                    await resp.prepare(request)
+                    for chunk in encoders.iter_dumps(r):
+                        await resp.write(chunk)
+                    await resp.write_eof()
+                    return resp
+                body = encoders.dumps(r)
+                content_type = 'application/json;charset=utf-8'
             # 存在对应模板的,则将套用模板,用request handler的结果进行渲染
             else:
-                resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
-                resp.content_type = 'text/html;charset=utf-8'
-                return resp
+                body = app['__templating__'].get_template(template).render(**r).encode('utf-8')
+                content_type = 'text/html;charset=utf-8'
+            if conditional and etag is None:
+                etag = _etag(body)
+                if _not_modified(request, etag, last_modified):
+                    return _set_validators(web.Response(status=304), etag, last_modified)
+            resp = web.Response(body=body)
+            resp.content_type = content_type
+            return _set_validators(resp, etag, last_modified)
         # 若是int，此时r为状态码
         if isinstance(r, int) and r >= 100 and r < 600:
             return web.Response(r)
@@ -151,8 +235,13 @@ def datetime_filter(t):
     dt = datetime.fromtimestamp(t)
     return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
 
+# 关闭连接池，destroy_pool()同时把记录的慢查询输出到日志
+async def on_cleanup(app):
+    await orm.destroy_pool()
+
 async def init(loop):
-    await orm.create_pool(loop=loop, host='127.0.0.1', port=3306, user='www-data', password='www-data', db='awesome')
+    await orm.create_pool(loop=loop, **configs.db)
+    await orm.start_counters(**configs.db.counters)
     """ 
     To get fully working example, you have to 
     (1)make application
@@ -160,8 +249,10 @@ async def init(loop):
     (3)create a server socket with Server as a protocol factory
     """
     # 创建web应用
-    app = web.Application(loop=loop, middlewares=[logger_factory, auth_factory, response_factory])
-    init_jinja2(app, filters=dict(datetime=datetime_filter))
+    app = web.Application(loop=loop, middlewares=[logger_factory, identity_factory, auth_factory, response_factory])
+    # 正文和评论在渲染模板时才转换为HTML，返回304时不用转换
+    init_jinja2(app, filters=dict(datetime=datetime_filter, markdown=markdown2.markdown, text2html=text2html))
+    app.on_cleanup.append(on_cleanup)
     # 将处理函数与对应的URL绑定，注册到创建的app.router中
     # 此处把通过GET方式传过来的对根目录的请求转发给index函数处理
     # app.router.add_route('GET', '/', index)
@@ -170,11 +261,21 @@ async def init(loop):
     # 用aiohttp.RequestHandlerFactory作为协议簇创建套接字，用make_handle()创建，用来处理HTTP协议
     # yield from 返回一个创建好的，绑定IP、端口、HTTP协议簇的监听服务的协程 
     # 此处调用协程创建一个TCP服务器,绑定到"127.0.0.1:9000"socket,并返回一个服务器对象
-    srv = await loop.create_server(app.make_handler(), '127.0.0.1', 9000)
+    handler = app.make_handler()
+    srv = await loop.create_server(handler, '127.0.0.1', 9000)
     logging.info('server started at http://127.0.0.1:9000...')
 
     # await orm.destroy_pool()
-    return srv
+    return app, srv, handler
+
+# 退出时先停止接受新连接，等正在处理的请求完成，再执行app的on_shutdown和on_cleanup（关闭连接池）
+async def shutdown(app, srv, handler):
+    srv.close()
+    await srv.wait_closed()
+    await app.shutdown()
+    await handler.shutdown(60.0)
+    await app.cleanup()
+    logging.info('server stopped.')
 
 
 # 从asyncio模块中直接获取一个eventloop（事件循环）的引用
@@ -182,6 +283,15 @@ async def init(loop):
 # loop是一个消息循环对象
 loop = asyncio.get_event_loop()
 # 在消息循环中执行协程
-loop.run_until_complete(init(loop))
-# 一直循环运行直到stop()
-loop.run_forever()
\ No newline at end of file
+app, srv, handler = loop.run_until_complete(init(loop))
+# 收到SIGINT或SIGTERM时停止消息循环；不支持add_signal_handler的平台上Ctrl+C会让run_forever()抛出KeyboardInterrupt
+for signum in (signal.SIGINT, signal.SIGTERM):
+    try:
+        loop.add_signal_handler(signum, loop.stop)
+    except NotImplementedError:
+        pass
+try:
+    # 一直循环运行直到stop()
+    loop.run_forever()
+finally:
+    loop.run_until_complete(shutdown(app, srv, handler))
\ No newline at end of file
@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Database backends used by orm: connection pool, cursors, transactions and SQL dialect.
+
+    mysql   aiomysql, the production database
+    sqlite  aiosqlite, a local file database for load tests and embedded deployments
+'''
+
+import asyncio, sqlite3
+from collections import deque
+
+# 两个驱动都是可选的，只需要安装实际使用的那个
+try:
+    import aiomysql
+except ImportError:
+    aiomysql = None
+
+try:
+    import aiosqlite
+except ImportError:
+    aiosqlite = None
+
+def _values_sql(n, columns):
+    return ', '.join(['(%s)' % ', '.join(['?'] * len(columns))] * n)
+
+def _columns_sql(columns):
+    return ', '.join(map(lambda c: '`%s`' % c, columns))
+
+class Backend(object):
+    '''
+    Base class of backends. Statements are written with ? placeholders and backquoted names,
+    driver_sql() converts them to what the driver expects.
+    '''
+
+    name = None
+    # upsert_sql()的影响行数能否区分插入和更新（MySQL插入为1，更新为2，值没变为0）
+    upsert_reports_insert = True
+    # 与aiomysql一致的游标类：conn.cursor(DictCursor)返回dict的行，SSDictCursor流式读取，Cursor返回tuple的行
+    DictCursor = None
+    SSDictCursor = None
+    Cursor = None
+
+    async def create_pool(self, loop, kw):
+        raise NotImplementedError
+
+    async def close_idle(self, pool, n):
+        ' close at most n free connections of pool. '
+        raise NotImplementedError
+
+    def driver_sql(self, sql):
+        return sql
+
+    def upsert_sql(self, table, columns, keys, updates, n=1):
+        ' insert n rows, rows whose keys already exist update the columns in updates instead. '
+        raise NotImplementedError
+
+    def insert_ignore_sql(self, table, columns, n=1):
+        ' insert n rows, rows whose keys already exist are skipped. '
+        raise NotImplementedError
+
+    def explain_sql(self, sql):
+        return 'explain ' + sql
+
+    def is_duplicate_key(self, e):
+        ' check if exception e raised by execute() is a primary key or unique key conflict. '
+        return False
+
+    def create_table_sql(self, table, columns, primary_key, keys, if_not_exists=False):
+        ' columns is a list of (name, type), keys a list of (name, unique, columns). '
+        raise NotImplementedError
+
+    async def indexes(self, select, table):
+        ' return set of (unique, columns) of the secondary indexes of table. '
+        raise NotImplementedError
+
+class MySQLBackend(Backend):
+
+    name = 'mysql'
+    if aiomysql is not None:
+        DictCursor = aiomysql.DictCursor
+        SSDictCursor = aiomysql.SSDictCursor
+        Cursor = aiomysql.Cursor
+
+    async def create_pool(self, loop, kw):
+        if aiomysql is None:
+            raise RuntimeError('aiomysql is required by the mysql backend.')
+        return (await aiomysql.create_pool(
+            host=kw.get('host', 'localhost'),
+            port=kw.get('port', 3306),
+            user=kw['user'],
+            password=kw['password'],
+            db=kw['db'],
+            charset=kw.get('charset', 'utf8'),
+            autocommit=kw.get('autocommit', True),  # 默认自动提交事务
+            maxsize=kw.get('maxsize', 10),          # 连接池最多的连接数，默认10个
+            minsize=kw.get('minsize', 1),           # 连接池最少的连接数，创建连接池时就预先建立好
+            pool_recycle=kw.get('recycle', -1),     # 连接建立超过这么多秒后在取出时重新连接，-1表示不回收
+            loop=loop                               # 传递消息循环event_loop实例用于异步执行
+        ))
+
+    # aiomysql只有关闭全部空闲连接的clear()，这里按clear()的实现只关闭n个
+    async def close_idle(self, pool, n):
+        async with pool._cond:
+            while n > 0 and pool._free:
+                await pool._free.popleft().ensure_closed()
+                n = n - 1
+            pool._cond.notify()
+
+    # SQL语句的占位符是?，而MySQL的占位符是%s, 这里要做一下替换
+    def driver_sql(self, sql):
+        return sql.replace('?', '%s')
+
+    def upsert_sql(self, table, columns, keys, updates, n=1):
+        return 'insert into `%s` (%s) values %s on duplicate key update %s' % (table, _columns_sql(columns), _values_sql(n, columns), ', '.join(map(lambda c: '`%s`=values(`%s`)' % (c, c), updates)))
+
+    def is_duplicate_key(self, e):
+        # 1062: ER_DUP_ENTRY
+        return aiomysql is not None and isinstance(e, aiomysql.IntegrityError) and e.args[0] == 1062
+
+    def insert_ignore_sql(self, table, columns, n=1):
+        return 'insert ignore into `%s` (%s) values %s' % (table, _columns_sql(columns), _values_sql(n, columns))
+
+    def create_table_sql(self, table, columns, primary_key, keys, if_not_exists=False):
+        L = []
+        for name, column_type in columns:
+            L.append('`%s` %s not null' % (name, column_type))
+        L.append('primary key (`%s`)' % primary_key)
+        for name, unique, names in keys:
+            L.append('%s `%s` (%s)' % ('unique key' if unique else 'key', name, _columns_sql(names)))
+        return 'create table %s`%s` (\n    %s\n) engine=innodb default charset=utf8;' % ('if not exists ' if if_not_exists else '', table, ',\n    '.join(L))
+
+    async def indexes(self, select, table):
+        rs = await select('select index_name _name_, non_unique _non_unique_, column_name _column_ from information_schema.statistics where table_schema=database() and table_name=? order by index_name, seq_in_index', [table])
+        live = dict()
+        for r in rs:
+            if r['_name_'] == 'PRIMARY':
+                continue
+            unique, columns = live.setdefault(r['_name_'], (not int(r['_non_unique_']), []))
+            columns.append(r['_column_'])
+        return set((unique, tuple(columns)) for unique, columns in live.values())
+
+# SQLite的游标，接口与ORM用到的aiomysql游标一致
+class SQLiteCursor(object):
+    ' rows as tuples. '
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._cur = None
+        self.rowcount = -1
+        self.description = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+        return False
+
+    async def execute(self, sql, args=()):
+        await self.close()
+        self._cur = await self._conn.execute(sql, args or ())
+        self.rowcount = self._cur.rowcount
+        self.description = self._cur.description
+
+    def _row(self, row):
+        return row
+
+    async def fetchone(self):
+        row = await self._cur.fetchone()
+        return None if row is None else self._row(row)
+
+    async def fetchmany(self, size):
+        return [self._row(r) for r in await self._cur.fetchmany(size)]
+
+    async def fetchall(self):
+        return [self._row(r) for r in await self._cur.fetchall()]
+
+    async def close(self):
+        if self._cur is not None:
+            await self._cur.close()
+            self._cur = None
+
+class SQLiteDictCursor(SQLiteCursor):
+    ' rows as dicts keyed by column name. '
+
+    async def execute(self, sql, args=()):
+        await super().execute(sql, args)
+        self._names = tuple(d[0] for d in self.description) if self.description else ()
+
+    def _row(self, row):
+        return dict(zip(self._names, row))
+
+class SQLiteConnection(object):
+    ' aiosqlite connection with the begin/commit/rollback/cursor interface of aiomysql. '
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self, cursorclass=SQLiteDictCursor):
+        return cursorclass(self._conn)
+
+    @property
+    def in_transaction(self):
+        return self._conn.in_transaction
+
+    async def begin(self):
+        await self._conn.execute('begin')
+
+    async def commit(self):
+        await self._conn.commit()
+
+    async def rollback(self):
+        await self._conn.rollback()
+
+    async def close(self):
+        await self._conn.close()
+
+class _SQLiteAcquire(object):
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    async def __aenter__(self):
+        self._conn = await self._pool.acquire()
+        return self._conn
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self._pool.release(self._conn)
+        return False
+
+class SQLitePool(object):
+    '''
+    Pool of aiosqlite connections with the size/freesize/get()/clear()/close() interface of aiomysql.
+    Each aiosqlite connection runs on its own thread.
+    '''
+
+    def __init__(self, path, minsize=1, maxsize=10, timeout=5.0):
+        self.path = path
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._free = deque()
+        self._used = set()
+        self._connecting = 0
+        self._closed = False
+        self._cond = asyncio.Condition()
+
+    @property
+    def size(self):
+        return len(self._free) + len(self._used) + self._connecting
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    async def _connect(self):
+        # isolation_level=None：默认自动提交，事务由begin()显式开始
+        conn = await aiosqlite.connect(self.path, isolation_level=None)
+        try:
+            # 多个连接同时写同一个文件时等待锁，而不是立即报database is locked
+            await (await conn.execute('pragma busy_timeout = %d' % int(self.timeout * 1000))).close()
+            if self.path != ':memory:':
+                # WAL模式下读不会被写阻塞；返回结果的游标不关闭时会一直占着读锁，其他连接无法打开数据库
+                await (await conn.execute('pragma journal_mode = wal')).close()
+        except BaseException:
+            # 关闭连接，否则它的线程会让进程无法退出
+            await conn.close()
+            raise
+        return SQLiteConnection(conn)
+
+    async def fill(self):
+        async with self._cond:
+            while self.size < self.minsize:
+                self._free.append(await self._connect())
+
+    def get(self):
+        return _SQLiteAcquire(self)
+
+    async def acquire(self):
+        async with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError('Cannot acquire connection after closing pool')
+                if self._free:
+                    conn = self._free.popleft()
+                    break
+                if self.size < self.maxsize:
+                    self._connecting = self._connecting + 1
+                    try:
+                        conn = await self._connect()
+                    finally:
+                        self._connecting = self._connecting - 1
+                    break
+                await self._cond.wait()
+            self._used.add(conn)
+            return conn
+
+    async def release(self, conn):
+        self._used.discard(conn)
+        # 出错时可能还留在事务里，回滚后再放回连接池
+        if conn.in_transaction:
+            await conn.rollback()
+        if self._closed:
+            await conn.close()
+        else:
+            self._free.append(conn)
+        async with self._cond:
+            self._cond.notify()
+
+    async def clear(self):
+        ' close all free connections. '
+        async with self._cond:
+            while self._free:
+                await self._free.popleft().close()
+
+    async def close_idle(self, n):
+        ' close at most n free connections. '
+        async with self._cond:
+            while n > 0 and self._free:
+                await self._free.popleft().close()
+                n = n - 1
+
+    def close(self):
+        self._closed = True
+
+    async def wait_closed(self):
+        await self.clear()
+        async with self._cond:
+            while self._used:
+                await self._cond.wait()
+
+class SQLiteBackend(Backend):
+    '''
+    SQLite through aiosqlite, the database file is given by path (default db + '.db').
+    SQLite accepts the "limit offset, count" form and backquoted names of MySQL,
+    so the statements of models are shared and only ?-placeholders, upsert, DDL and EXPLAIN differ.
+    '''
+
+    name = 'sqlite'
+    # SQLite的upsert插入和更新的影响行数都是1
+    upsert_reports_insert = False
+    DictCursor = SQLiteDictCursor
+    # SQLite的游标本来就是逐行从文件读取的，不需要单独的流式游标
+    SSDictCursor = SQLiteDictCursor
+    Cursor = SQLiteCursor
+
+    async def create_pool(self, loop, kw):
+        if aiosqlite is None:
+            raise RuntimeError('aiosqlite is required by the sqlite backend.')
+        path = kw.get('path', None) or '%s.db' % kw.get('db', 'awesome')
+        maxsize = kw.get('maxsize', 10)
+        if path == ':memory:':
+            # 每个连接打开的都是各自独立的内存数据库，只能用一个连接
+            maxsize = 1
+        pool = SQLitePool(path, min(kw.get('minsize', 1), maxsize), maxsize, kw.get('timeout', 5.0))
+        await pool.fill()
+        return pool
+
+    async def close_idle(self, pool, n):
+        await pool.close_idle(n)
+
+    def upsert_sql(self, table, columns, keys, updates, n=1):
+        return 'insert into `%s` (%s) values %s on conflict (%s) do update set %s' % (table, _columns_sql(columns), _values_sql(n, columns), _columns_sql(keys), ', '.join(map(lambda c: '`%s`=excluded.`%s`' % (c, c), updates)))
+
+    def insert_ignore_sql(self, table, columns, n=1):
+        return 'insert or ignore into `%s` (%s) values %s' % (table, _columns_sql(columns), _values_sql(n, columns))
+
+    def explain_sql(self, sql):
+        return 'explain query plan ' + sql
+
+    def is_duplicate_key(self, e):
+        return isinstance(e, sqlite3.IntegrityError) and str(e).startswith('UNIQUE constraint failed')
+
+    def create_table_sql(self, table, columns, primary_key, keys, if_not_exists=False):
+        L = []
+        for name, column_type in columns:
+            L.append('`%s` %s not null' % (name, column_type))
+        L.append('primary key (`%s`)' % primary_key)
+        exists = 'if not exists ' if if_not_exists else ''
+        stmts = ['create table %s`%s` (\n    %s\n);' % (exists, table, ',\n    '.join(L))]
+        # SQLite的索引名在整个数据库内唯一，加上表名作前缀
+        for name, unique, names in keys:
+            stmts.append('create %sindex %s`%s_%s` on `%s` (%s);' % ('unique ' if unique else '', exists, table, name, table, _columns_sql(names)))
+        return '\n'.join(stmts)
+
+    async def indexes(self, select, table):
+        live = set()
+        for r in await select('pragma index_list(`%s`)' % table, []):
+            # origin为pk的是主键自动建立的索引
+            if r['origin'] == 'pk':
+                continue
+            columns = tuple(c['name'] for c in await select('pragma index_info(`%s`)' % r['name'], []))
+            live.add((bool(r['unique']), columns))
+        return live
+
+BACKENDS = dict(mysql=MySQLBackend, sqlite=SQLiteBackend)
+
+def get_backend(name):
+    '''
+    Return a new backend by name: mysql or sqlite.
+    '''
+    if name not in BACKENDS:
+        raise ValueError('Invalid backend value: %s' % name)
+    return BACKENDS[name]()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Micro benchmark of request dispatch through RequestHandler (no server needed).
+
+Usage: python3 bench_coroweb.py
+'''
+
+import asyncio, time
+from urllib import parse
+
+from aiohttp import web
+
+from coroweb import _logger, get, post, RequestHandler, has_request_arg, has_var_kw_arg, has_named_kw_args, get_named_kw_args, get_required_kw_args
+from apis import APIError
+
+# 只提供RequestHandler用到的属性
+class FakeRequest(object):
+
+    def __init__(self, method, query_string='', match_info=None, content_type='', body=None):
+        self.method = method
+        self.query_string = query_string
+        self.match_info = match_info or {}
+        self.content_type = content_type
+        self._body = body
+
+    async def json(self):
+        return dict(self._body)
+
+    async def post(self):
+        return dict(self._body)
+
+# 旧版RequestHandler.__call__：每个请求都重新判断读取哪种参数、逐个复制命名参数、逐个检查必需参数
+class LegacyRequestHandler(object):
+
+    def __init__(self, app, fn):
+        self._app = app
+        self._func = fn
+        self._has_request_arg = has_request_arg(fn)
+        self._has_var_kw_arg = has_var_kw_arg(fn)
+        self._has_named_kw_args = has_named_kw_args(fn)
+        self._named_kw_args = get_named_kw_args(fn)
+        self._required_kw_args = get_required_kw_args(fn)
+
+    async def __call__(self, request):
+        kw = None
+        if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
+            if request.method == 'POST':
+                if not request.content_type:
+                    return web.HTTPBadRequest('Missing Content-Type.')
+                ct = request.content_type.lower()
+                if ct.startswith('application/json'):
+                    params = await request.json()
+                    if not isinstance(params, dict):
+                        return web.HTTPBadRequest('JSON body must be object.')
+                    kw = params
+                elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
+                    params = await request.post()
+                    kw = dict(**params)
+                else:
+                    return web.HTTPBadRequest('Unsupported Content-Type: %s' % request.content_type)
+            if request.method == 'GET':
+                qs = request.query_string
+                if qs:
+                    kw = dict()
+                    for k, v in parse.parse_qs(qs, True).items():
+                        kw[k] = v[0]
+        if kw is None:
+            kw = dict(**request.match_info)
+        else:
+            if not self._has_var_kw_arg and self._named_kw_args:
+                copy = dict()
+                for name in self._named_kw_args:
+                    if name in kw:
+                        copy[name] = kw[name]
+                kw = copy
+            for k, v in request.match_info.items():
+                kw[k] = v
+        if self._has_request_arg:
+            kw['request'] = request
+        if self._required_kw_args:
+            for name in self._required_kw_args:
+                if not name in kw:
+                    return web.HTTPBadRequest('Missing argument: %s' % name)
+        _logger.info('call with args: %s', kw)
+        try:
+            r = await self._func(**kw)
+            return r
+        except APIError as e:
+            return dict(error=e.error, data=e.data, message=e.message)
+
+@get('/api/blogs')
+async def api_blogs(*, page='1', cursor=None):
+    return page
+
+@get('/blog/{id}')
+async def get_blog(id):
+    return id
+
+@post('/api/blogs/{id}/comments')
+async def api_create_comment(id, request, *, content):
+    return content
+
+CASES = [
+    ('GET /api/blogs?page=2', api_blogs, FakeRequest('GET', 'page=2&sort=desc')),
+    ('GET /blog/{id}', get_blog, FakeRequest('GET', match_info={'id': '001'})),
+    ('POST /api/blogs/{id}/comments (json)', api_create_comment, FakeRequest('POST', match_info={'id': '001'}, content_type='application/json', body={'content': 'hi'})),
+]
+
+# 两种方式交替运行多轮，各取最快的一轮，减少机器负载波动的影响
+def requests_per_second(handlers, request, number, repeat=5):
+    async def run(handler):
+        for i in range(number):
+            await handler(request)
+    loop = asyncio.new_event_loop()
+    try:
+        best = [None] * len(handlers)
+        for i in range(repeat):
+            for j, handler in enumerate(handlers):
+                start = time.perf_counter()
+                loop.run_until_complete(run(handler))
+                t = time.perf_counter() - start
+                best[j] = t if best[j] is None else min(best[j], t)
+    finally:
+        loop.close()
+    return [number / t for t in best]
+
+def bench_dispatch(number=100000):
+    print('%-40s %12s %12s %8s' % ('requests/sec', 'before', 'after', 'speedup'))
+    for name, fn, request in CASES:
+        before, after = LegacyRequestHandler(None, fn), RequestHandler(None, fn)
+        # 先检查两种方式绑定的参数完全一致
+        loop = asyncio.new_event_loop()
+        assert loop.run_until_complete(before(request)) == loop.run_until_complete(after(request)), name
+        loop.close()
+        r0, r1 = requests_per_second((before, after), request, number)
+        print('%-40s %12.0f %12.0f %7.2fx' % (name, r0, r1, r1 / r0))
+
+if __name__ == '__main__':
+    bench_dispatch()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Micro benchmarks for the ORM hot paths (no database needed).
+
+Usage: python3 bench_orm.py
+'''
+
+import timeit, tracemalloc
+
+from models import User, Blog, Comment
+
+# 旧版findAll/find/findNumber每次请求都要做的字符串工作：拼接list片段，再把?替换为%s
+def legacy_findAll_sql(cls, where=None, args=None, **kw):
+    sql = [cls.__select__]
+    if where:
+        sql.append('where')
+        sql.append(where)
+    if args is None:
+        args = []
+    orderBy = kw.get('orderBy', None)
+    if orderBy:
+        sql.append('order by')
+        sql.append(orderBy)
+    limit = kw.get('limit', None)
+    if limit is not None:
+        sql.append('limit')
+        if isinstance(limit, int):
+            sql.append('?')
+            args.append(limit)
+        elif isinstance(limit, tuple) and len(limit) == 2:
+            sql.append('?, ?')
+            args.extend(limit)
+    return ' '.join(sql).replace('?', '%s'), args
+
+def legacy_find_sql(cls, pk):
+    return ('%s where `%s`=?' % (cls.__select__, cls.__primary_key__)).replace('?', '%s'), [pk]
+
+def legacy_findNumber_sql(cls, selectField, where=None):
+    sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
+    if where:
+        sql.append('where')
+        sql.append(where)
+    return ' '.join(sql).replace('?', '%s')
+
+def cached_findAll_sql(cls, where=None, args=None, orderBy=None, limit=None):
+    args = list(args) if args else []
+    shape = None
+    if isinstance(limit, int):
+        shape = 1
+        args.append(limit)
+    elif isinstance(limit, tuple):
+        shape = 2
+        args.extend(limit)
+    return cls._findAllSql(where, orderBy, shape), args
+
+def cached_find_sql(cls, pk):
+    return cls.__statements__['find'], [pk]
+
+def cached_findNumber_sql(cls, selectField, where=None):
+    return cls._findNumberSql(selectField, where)
+
+CASES = [
+    ('Blog.find(id)',
+        lambda: legacy_find_sql(Blog, '001'),
+        lambda: cached_find_sql(Blog, '001')),
+    ('Blog.findAll(orderBy, limit=(o, n))',
+        lambda: legacy_findAll_sql(Blog, orderBy='created_at desc', limit=(10, 10)),
+        lambda: cached_findAll_sql(Blog, orderBy='created_at desc', limit=(10, 10))),
+    ('Comment.findAll(where, orderBy)',
+        lambda: legacy_findAll_sql(Comment, 'blog_id=?', ['001'], orderBy='created_at desc'),
+        lambda: cached_findAll_sql(Comment, 'blog_id=?', ['001'], orderBy='created_at desc')),
+    ('User.findNumber(count(id))',
+        lambda: legacy_findNumber_sql(User, 'count(id)'),
+        lambda: cached_findNumber_sql(User, 'count(id)')),
+]
+
+def bench_statements(number=200000):
+    print('%-40s %12s %12s %8s' % ('statement preparation', 'before(us)', 'after(us)', 'speedup'))
+    for name, before, after in CASES:
+        # 先检查两种方式生成的SQL完全一致
+        assert before() == after(), name
+        t0 = min(timeit.repeat(before, number=number, repeat=3)) / number * 1e6
+        t1 = min(timeit.repeat(after, number=number, repeat=3)) / number * 1e6
+        print('%-40s %12.3f %12.3f %7.1fx' % (name, t0, t1, t0 / t1))
+
+# 模拟游标返回的Comment行：DictCursor每行一个dict，普通游标每行一个tuple
+def comment_rows(n):
+    columns = [Comment.__primary_key__] + Comment.__fields__
+    rows = [('%050d' % i, '%050d' % (i % 100), '%050d' % (i % 7), 'user %d' % (i % 7), 'http://www.gravatar.com/avatar/%d' % (i % 7), 'comment %d' % i, 1500000000.0 + i) for i in range(n)]
+    return rows, [dict(zip(columns, r)) for r in rows]
+
+# 每行对象占用的内存，包括游标返回的dict或tuple
+def memory_per_row(build, n):
+    tracemalloc.start()
+    objs = build(n)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objs
+    return size / n
+
+def bench_rows(n=10000, number=20):
+    print('%-40s %12s %12s %8s' % ('hydrate %d comments' % n, 'Model', 'Row', 'ratio'))
+    tuples, dicts = comment_rows(n)
+    model = Comment._load(dicts[0])
+    row = Comment.__row__(*tuples[0])
+    assert row._asdict() == dict(model), 'row and model differ'
+    t0 = min(timeit.repeat(lambda: [Comment._load(r) for r in dicts], number=number, repeat=3)) / number * 1e3
+    t1 = min(timeit.repeat(lambda: [Comment.__row__(*r) for r in tuples], number=number, repeat=3)) / number * 1e3
+    print('%-40s %12.3f %12.3f %7.1fx' % ('time (ms)', t0, t1, t0 / t1))
+    m0 = memory_per_row(lambda k: [Comment._load(r) for r in comment_rows(k)[1]], n)
+    m1 = memory_per_row(lambda k: [Comment.__row__(*r) for r in comment_rows(k)[0]], n)
+    print('%-40s %12.0f %12.0f %7.1fx' % ('memory per row (bytes)', m0, m1, m0 / m1))
+    a, b = model, row
+    t0 = min(timeit.repeat(lambda: (a.content, a.user_name, a.created_at), number=200000, repeat=3)) / 200000 * 1e9
+    t1 = min(timeit.repeat(lambda: (b.content, b.user_name, b.created_at), number=200000, repeat=3)) / 200000 * 1e9
+    print('%-40s %12.0f %12.0f %7.1fx' % ('3 attribute reads (ns)', t0, t1, t0 / t1))
+
+if __name__ == '__main__':
+    bench_statements()
+    print()
+    bench_rows()
@@ -7,12 +7,58 @@ Default configurations.
 
 configs = {
     'debug': True,
+    # 日志：levels按类别设置级别（sql、request），sample按类别每n个请求记录1个
+    'logging': {
+        'level': 'INFO',
+        'levels': {
+            'sql': 'INFO',
+            'request': 'INFO'
+        },
+        'sample': {
+            'sql': 1,
+            'request': 1
+        }
+    },
     'db': {
+        # 数据库后端：mysql，或者sqlite（数据库文件为path，用于压测和嵌入式部署）
+        'backend': 'mysql',
+        'path': 'awesome.db',
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'www-data',
         'password': 'www-data',
-        'db': 'awesome'
+        'db': 'awesome',
+        # 连接池的连接数范围，minsize个连接在启动时预先建立
+        'minsize': 1,
+        'maxsize': 10,
+        # 连接建立超过这么多秒后重新连接，-1表示不回收
+        'recycle': 3600,
+        # 自适应模式下，每adapt_interval秒根据等待连接的时间和使用率在minsize和maxsize之间调整
+        'adaptive': False,
+        'adapt_interval': 10.0,
+        # 只读副本，每一项覆盖上面主库的配置，如{'host': '10.0.0.2'}
+        'replicas': [],
+        # round-robin或least-busy
+        'replica_strategy': 'round-robin',
+        # 同一个会话写入后多少秒内的读请求仍然发往主库
+        'read_your_writes': 1.0,
+        # 查询结果缓存：过期秒数、最多缓存的结果集数和总行数
+        'cache': {
+            'ttl': 60.0,
+            'max_entries': 1000,
+            'max_rows': 100000
+        },
+        # 行数计数器与数据库校正的间隔秒数
+        'counters': {
+            'interval': 300.0
+        },
+        # 慢查询日志：超过threshold秒的语句记录最近的size条，select语句同时记录EXPLAIN的结果，同一条SQL在explain_ttl秒内只EXPLAIN一次
+        'slow_log': {
+            'threshold': 0.2,
+            'size': 200,
+            'explain': True,
+            'explain_ttl': 600.0
+        }
     },
     'session': {
         'secret': 'Awesome'
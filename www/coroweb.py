@@ -3,6 +3,9 @@ import functools
 from urllib import parse
 from aiohttp import web
 from apis import APIError
+import logs
+
+_logger = logs.get_logger('request')
 
 # 装饰器就是接受一个函数作为参数，并返回一个函数的高阶函数
 # 如果decorator本身需要传入参数（如这里的path），那就需要编写一个返回decorator的高阶函数
@@ -101,103 +104,152 @@ def has_request_arg(fn):
             raise ValueError('request parameter must be the last named parameter in function: %s%s' % (fn.__name__, str(sig)))
     return found
 
+# 按注解转换参数类型，如page: int；其他注解不做转换
+def _to_bool(value):
+    if isinstance(value, bool):
+        return value
+    value = str(value).lower()
+    if value in ('1', 'true', 'yes', 'on'):
+        return True
+    if value in ('', '0', 'false', 'no', 'off'):
+        return False
+    raise ValueError('Invalid bool value: %s' % value)
+
+_COERCIONS = {int: int, float: float, str: str, bool: _to_bool}
+
+# 获取有类型注解且需要转换的参数，返回(参数名, 转换函数)的tuple
+def get_coercions(fn):
+    args = []
+    params = inspect.signature(fn).parameters
+    for name, param in params.items():
+        convert = _COERCIONS.get(param.annotation)
+        if convert is not None and name != 'request':
+            args.append((name, convert))
+    return tuple(args)
+
+# 读取GET请求的query参数，同名的参数取第一个值
+# parse_qsl解析query，相当于把check_keywords=yes&area=default解析成[('check_keywords', 'yes'), ('area', 'default')]
+def _query_lines(keep):
+    return [
+        'qs = request.query_string',
+        'if qs:',
+        '    kw = {}',
+        '    for k, v in parse_qsl(qs, True):',
+        '        if k not in kw%s:' % (' and k in keep' if keep else ''),
+        '            kw[k] = v',
+        'else:',
+        '    kw = None',
+    ]
+
+# 读取POST请求的消息主体，出错时返回400的响应
+# application/x-www-form-urlencoded: The body of the HTTP message sent to the server is essentially one giant query string
+# multipart/form-data: With this method of transmitting name/value pairs, each pair is represented as a "part" in a MIME message
+def _body_lines(keep):
+    L = [
+        'ct = request.content_type',
+        'if not ct:',
+        '    return web.HTTPBadRequest(text=\'Missing Content-Type.\')',
+        'ct = ct.lower()',
+        'if ct.startswith(\'application/json\'):',
+        '    kw = await request.json()',
+        '    if not isinstance(kw, dict):',
+        '        return web.HTTPBadRequest(text=\'JSON body must be object.\')',
+        'elif ct.startswith(\'application/x-www-form-urlencoded\') or ct.startswith(\'multipart/form-data\'):',
+        '    kw = dict(**(await request.post()))',
+        'else:',
+        '    return web.HTTPBadRequest(text=\'Unsupported Content-Type: %s\' % request.content_type)',
+    ]
+    if keep:
+        # remove all unamed kw:
+        L.extend([
+            'params, kw = kw, {}',
+            'for k in keep:',
+            '    if k in params:',
+            '        kw[k] = params[k]',
+        ])
+    return L
+
+def _indent(lines):
+    return ['    ' + line for line in lines]
+
+def make_binder(fn, method=None):
+    '''
+    Generate call(request) for fn at registration: read the query or body params fn needs,
+    keep its named args, merge match_info, check required args, coerce annotated args and call fn.
+    Everything decided by the signature and method of fn is resolved here,
+    so each request runs one straight-line function.
+    '''
+    has_var_kw = has_var_kw_arg(fn)
+    named = get_named_kw_args(fn)
+    # 没有**kw时只保留命名关键字参数
+    keep = named if named and not has_var_kw else None
+    namespace = dict(fn=fn, keep=keep, web=web, parse_qsl=parse.parse_qsl, logging=logging, _logger=_logger, APIError=APIError)
+    L = []
+    # 只有带命名关键字参数或**kw的函数才需要读取query或消息主体，GET和POST的处理函数各自只生成一种
+    if not (has_var_kw or named):
+        L.append('kw = None')
+    elif method == 'GET':
+        L.extend(_query_lines(keep))
+    elif method == 'POST':
+        L.extend(_body_lines(keep))
+    else:
+        # 没有通过@get/@post注册的函数按请求方法选择
+        L.append('if request.method == \'POST\':')
+        L.extend(_indent(_body_lines(keep)))
+        L.append('elif request.method == \'GET\':')
+        L.extend(_indent(_query_lines(keep)))
+        L.append('else:')
+        L.append('    kw = None')
+    # 参数都来自URL里的变量时直接用request.match_info，如'/blog/{id}'
+    L.extend([
+        'if kw is None:',
+        '    kw = dict(request.match_info)',
+        'else:',
+        '    for k, v in request.match_info.items():',
+        '        if k in kw:',
+        '            logging.warning(\'Duplicate arg name in named arg and kw args: %s\' % k)',
+        '        kw[k] = v',
+    ])
+    if has_request_arg(fn):
+        L.append('kw[\'request\'] = request')
+    for name in get_required_kw_args(fn):
+        L.append('if %r not in kw:' % name)
+        L.append('    return web.HTTPBadRequest(text=%r)' % ('Missing argument: %s' % name))
+    for i, (name, convert) in enumerate(get_coercions(fn)):
+        namespace['convert%d' % i] = convert
+        L.extend([
+            'if %r in kw:' % name,
+            '    try:',
+            '        kw[%r] = convert%d(kw[%r])' % (name, i, name),
+            '    except (TypeError, ValueError):',
+            '        return web.HTTPBadRequest(text=%r)' % ('Invalid argument: %s' % name),
+        ])
+    L.extend([
+        '_logger.info(\'call with args: %s\', kw)',
+        'try:',
+        '    return (await fn(**kw))',
+        'except APIError as e:',
+        '    return dict(error=e.error, data=e.data, message=e.message)',
+    ])
+    exec('async def call(request):\n%s\n' % '\n'.join(_indent(L)), namespace)
+    return namespace['call']
+
 # 用RequestHandler()来封装一个URL处理函数
 # 目的就是从URL函数中分析其需要接收的参数，从request中获取必要的参数
 # 调用URL函数，然后把结果转换为web.Response对象
 class RequestHandler(object):
 
     # RequestHandler()时会执行__init__
+    # 注册时为处理函数生成专用的函数，完成读取参数和调用，请求时直接调用它
     def __init__(self, app, fn):
         self._app = app
         self._func = fn
-        self._has_request_arg = has_request_arg(fn)
-        self._has_var_kw_arg = has_var_kw_arg(fn)
-        self._has_named_kw_args = has_named_kw_args(fn)
-        self._named_kw_args = get_named_kw_args(fn)
-        self._required_kw_args = get_required_kw_args(fn)
+        self._call = make_binder(fn, getattr(fn, '__method__', None))
 
     # 定义了__call__()方法，这个类就相当于一个函数，因此可以将其实例视为函数
-    # RequestHandler()()时会执行__call__
-    async def __call__(self, request):
-        # A BaseRequest/Request are dict-like objects, allowing them to be used for sharing data among Middlewares and Signals handlers.
-        kw = None
-        if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
-            if request.method == 'POST':
-                if not request.content_type:
-                    return web.HTTPBadRequest('Missing Content-Type.')
-                ct = request.content_type.lower()
-                if ct.startswith('application/json'):
-                    # aiohttp文档 request的coroutine json(*, loads=json.loads)
-                    # Read request body decoded as json. Accepts str and returns dict with parsed JSON. 
-                    params = await request.json()
-                    if not isinstance(params, dict):
-                        return web.HTTPBadRequest('JSON body must be object.')
-                    kw = params
-                # 两者表示消息主题是表单
-                # application/x-www-form-urlencoded: 
-                # The body of the HTTP message sent to the server is essentially one giant query string --
-                # name/value pairs are separated by the ampersand (&), 
-                # and names are separated from values by the equals symbol (=).
-                # multipart/form-data: 
-                # With this method of transmitting name/value pairs, each pair is represented as a "part" in a MIME message. 
-                # Parts are separated by a particular string boundary.
-                # Each part has its own set of MIME headers like Content-Type, and particularly Content-Disposition, which can give each part its "name."
-                elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
-                    # aiohttp文档 request的coroutine post()
-                    # A coroutine that reads POST parameters from request body.
-                    # Returns MultiDictProxy instance filled with parsed data.
-                    # MultiDictProxy provides a dynamic view on the multidict’s entries, which means that when the multidict changes, the view reflects these changes.
-                    params = await request.post()
-                    kw = dict(**params)
-                else:
-                    return web.HTTPBadRequest('Unsupported Content-Type: %s' % request.content_type)
-            if request.method == 'GET':
-                # query_string: The query string in the URL
-                qs = request.query_string
-                if qs:
-                    kw = dict()
-                    # parse.parse_qs解析query，相当于把check_keywords=yes&area=default解析成{'check_keywords': ['yes'], 'area': ['default']}
-                    for k, v in parse.parse_qs(qs, True).items():
-                        kw[k] = v[0]
-        if kw is None:
-            # match_info貌似是@get装饰器里的参数？
-            # Resource may have variable path also. For instance, a resource
-            # with the path '/a/{name}/c' would match all incoming requests
-            # with paths such as '/a/b/c', '/a/1/c', and '/a/etc/c'.
-
-            # A variable part is specified in the form {identifier}, where the
-            # identifier can be used later in a request handler to access the
-            # matched value for that part. This is done by looking up the
-            # identifier in the Request.match_info mapping:
-            kw = dict(**request.match_info)
-        else:
-            if not self._has_var_kw_arg and self._named_kw_args:
-                # remove all unamed kw:
-                copy = dict()
-                for name in self._named_kw_args:
-                    if name in kw:
-                        copy[name] = kw[name]
-                kw = copy
-            # check named arg:
-            for k, v in request.match_info.items():
-                if k in kw:
-                    logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
-                kw[k] = v
-        # 给request参数赋值
-        if self._has_request_arg:
-            kw['request'] = request
-        # check required kw:
-        if self._required_kw_args:
-            for name in self._required_kw_args:
-                if not name in kw:
-                    return web.HTTPBadRequest('Missing argument: %s' % name)
-        logging.info('call with args: %s' % str(kw))
-        try:
-            # 执行handler模块里的函数
-            r = await self._func(**kw)
-            return r
-        except APIError as e:
-            return dict(error=e.error, data=e.data, message=e.message)
+    # RequestHandler()()时会执行__call__，直接返回生成的函数的协程，不再多包一层
+    def __call__(self, request):
+        return self._call(request)
 
 # 添加静态页面的路径
 def add_static(app):
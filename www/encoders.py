@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+JSON serialization of responses.
+
+Objects the JSON backend cannot encode natively (Row, Page, CursorPage) are encoded by functions
+compiled once per class from their field lists. orjson or ujson is used when installed,
+and dicts holding large lists can be encoded in chunks for streaming.
+'''
+
+import json
+
+# 可选的更快的JSON库，按orjson、ujson、标准库的顺序使用
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+from orm import Row
+
+# 超过这么多项的列表分块编码，见iter_dumps()
+CHUNK_SIZE = 500
+
+# 各个类的编码函数：把对象转换为JSON能直接编码的dict
+__encoders = dict()
+
+# 按字段名生成编码函数，直接读取每个属性，不经过__dict__或getattr循环
+def compile_encoder(names):
+    '''
+    Return a function encoding an object to a dict of the attributes in names.
+    '''
+    namespace = dict()
+    items = ', '.join('%r: o.%s' % (name, name) for name in names)
+    exec('def encode(o):\n    return {%s}\n' % items, namespace)
+    return namespace['encode']
+
+def register(cls, names=None, encoder=None):
+    '''
+    Register how to encode objects of cls: by the attribute names, or by an encoder function.
+    '''
+    __encoders[cls] = encoder if encoder is not None else compile_encoder(names)
+
+# 第一次遇到某个类时生成它的编码函数：Row按它的列，有__json_fields__的类（如Page）按声明的字段，其他对象沿用__dict__
+def _encoder_of(cls):
+    encoder = __encoders.get(cls)
+    if encoder is None:
+        if issubclass(cls, Row):
+            encoder = compile_encoder(cls.__slots__)
+        elif hasattr(cls, '__json_fields__'):
+            encoder = compile_encoder(cls.__json_fields__)
+        else:
+            encoder = lambda o: o.__dict__
+        __encoders[cls] = encoder
+    return encoder
+
+def _default(o):
+    return _encoder_of(o.__class__)(o)
+
+# Model是dict的子类，各个JSON库都直接编码，不需要编码函数
+if orjson is not None:
+    backend = 'orjson'
+    def dumps(obj):
+        ' encode obj as UTF-8 JSON bytes. '
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+elif ujson is not None:
+    backend = 'ujson'
+    def dumps(obj):
+        ' encode obj as UTF-8 JSON bytes. '
+        return ujson.dumps(obj, ensure_ascii=False, default=_default).encode('utf-8')
+else:
+    backend = 'json'
+    # json.dumps()带参数时每次都要新建一个JSONEncoder，这里只建一次
+    __encoder = json.JSONEncoder(ensure_ascii=False, default=_default)
+    def dumps(obj):
+        ' encode obj as UTF-8 JSON bytes. '
+        return __encoder.encode(obj).encode('utf-8')
+
+def is_large(obj, chunk_size=CHUNK_SIZE):
+    '''
+    Return True if obj is a dict holding a list longer than chunk_size.
+    '''
+    if not isinstance(obj, dict):
+        return False
+    for v in obj.values():
+        if isinstance(v, (list, tuple)) and len(v) > chunk_size:
+            return True
+    return False
+
+def iter_dumps(obj, chunk_size=CHUNK_SIZE):
+    '''
+    Encode obj as JSON bytes chunks: lists in a dict longer than chunk_size are encoded
+    chunk_size items at a time, so the whole document is never built in memory.
+    '''
+    if not isinstance(obj, dict):
+        yield dumps(obj)
+        return
+    sep = b'{'
+    for k, v in obj.items():
+        head = sep + dumps(str(k)) + b':'
+        sep = b','
+        if isinstance(v, (list, tuple)) and len(v) > chunk_size:
+            yield head + b'['
+            for i in range(0, len(v), chunk_size):
+                # 去掉每一块两端的[]，块之间用逗号连接
+                chunk = dumps(v[i:i + chunk_size])[1:-1]
+                yield chunk if i == 0 else b',' + chunk
+            yield b']'
+        else:
+            yield head + dumps(v)
+    yield b'}' if sep == b',' else b'{}'
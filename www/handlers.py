@@ -3,15 +3,15 @@
 
 ' url handlers '
 
-import re, time, json, logging, hashlib, base64, asyncio
+import re, time, logging, hashlib, base64, asyncio
 from aiohttp import web
 from coroweb import get, post
-from apis import APIValueError, APIResourceNotFoundError, APIError, APIPermissionError, Page
+from apis import APIValueError, APIResourceNotFoundError, APIError, APIPermissionError, Page, CursorPage
 
 from models import User, Comment, Blog, next_id
+from orm import backend, transaction, gather_queries, pool_stats_text, cache_stats_text, slow_queries_text
 from config import configs
-
-import markdown2
+import encoders
 
 # cookie名，用于设置cookie
 COOKIE_NAME = 'awesession'
@@ -59,6 +59,8 @@ async def cookie2user(cookie_str):
         if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
             logging.info('invalid sha1')
             return None
+        # 复制一份再隐藏口令，不要改动identity map里的对象
+        user = User(**user)
         user.passwd = '******'
         return user
     except Exception as e:
@@ -110,7 +112,7 @@ async def authenticate(*, email, passwd):
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
     user.passwd = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = encoders.dumps(user)
     return r
 
 # 注册
@@ -139,13 +141,12 @@ def signout(request):
 # 日志详情页
 @get('/blog/{id}')
 async def get_blog(id):
-    blog = await Blog.find(id)
-    comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
-    for c in comments:
-        c.html_content = text2html(c.content)
-    blog.html_content = markdown2.markdown(blog.content)
+    # 日志和评论互不依赖，并发查询
+    blog, comments = await gather_queries(Blog.find(id), Comment.findAll('blog_id=?', [id], orderBy='created_at desc'))
+    # 页面由日志和评论决定，以它们为版本：客户端缓存有效时不用转换markdown和渲染模板
     return {
         '__template__': 'blog.html',
+        '__version__': (blog, comments),
         'blog': blog,
         'comments': comments
     }
@@ -196,15 +197,32 @@ def manage_users(*, page='1'):
         'page_index': get_page_index(page)
     }
 
+# 连接池、语句和查询缓存的统计，纯文本格式
+@get('/manage/stats/pool')
+def manage_pool_stats():
+    text = pool_stats_text() + cache_stats_text()
+    return web.Response(body=text.encode('utf-8'), content_type='text/plain', charset='UTF-8')
+
+# 最近的慢查询，纯文本格式
+@get('/manage/stats/slow')
+def manage_slow_queries():
+    return web.Response(body=slow_queries_text().encode('utf-8'), content_type='text/plain', charset='UTF-8')
+
 # 获取日志
+# 带cursor参数时使用keyset分页，cursor为空字符串表示第一页，任何一页的代价都与页数无关
 @get('/api/blogs')
-async def api_blogs(*, page='1'):
+async def api_blogs(*, page='1', cursor=None):
+    if cursor is not None:
+        p = CursorPage(cursor)
+        blogs = await Blog.findAll(orderBy='created_at desc', after=p.after, limit=p.limit, columns=Blog.defer('content'))
+        return dict(page=p, blogs=p.paginate(blogs))
     page_index = get_page_index(page)
-    num = await Blog.findNumber('count(id)')
+    # 总数和当前页并发查询：先假定页号有效算出offset，页号超出范围时Page的limit为0，丢弃查到的结果
+    # 列表页不显示正文，不查询content列
+    num, blogs = await gather_queries(Blog.findNumber('count(id)'), Blog.findAll(orderBy='created_at desc', limit=Page.slice(page_index), columns=Blog.defer('content')))
     p = Page(num, page_index)
-    if num == 0:
+    if p.limit == 0:
         return dict(page=p, blogs=())
-    blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
     return dict(page=p, blogs=blogs)
 
 # 获取某个日志
@@ -254,13 +272,18 @@ async def api_delete_blog(request, *, id):
 
 # 获取评论
 @get('/api/comments')
-async def api_comments(*, page='1'):
+async def api_comments(*, page='1', cursor=None):
+    if cursor is not None:
+        p = CursorPage(cursor)
+        # 只读的列表直接返回Row对象，不构造Model
+        comments = await Comment.findAll(orderBy='created_at desc', after=p.after, limit=p.limit, raw=True)
+        return dict(page=p, comments=p.paginate(comments))
     page_index = get_page_index(page)
     num = await Comment.findNumber('count(id)')
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, comments=())
-    comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit), raw=True)
     return dict(page=p, comments=comments)
 
 # 创建评论
@@ -271,11 +294,13 @@ async def api_create_comment(id, request, *, content):
         raise APIPermissionError('Please signin first.')
     if not content or not content.strip():
         raise APIValueError('content')
-    blog = await Blog.find(id)
-    if blog is None:
-        raise APIResourceNotFoundError('Blog')
-    comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content.strip())
-    await comment.save()
+    # 查找日志和插入评论在同一个连接、同一个事务里完成
+    async with transaction():
+        blog = await Blog.find(id)
+        if blog is None:
+            raise APIResourceNotFoundError('Blog')
+        comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content.strip())
+        await comment.save()
     return comment
 
 # 删除评论
@@ -288,9 +313,22 @@ async def api_delete_comments(id, request):
     await c.remove()
     return dict(id=id)
 
+# 删除某个日志下的全部评论
+@post('/api/blogs/{id}/comments/delete')
+async def api_delete_blog_comments(id, request):
+    check_admin(request)
+    rows = await Comment.remove_where('`blog_id`=?', [id])
+    return dict(id=id, deleted=rows)
+
 # 获取用户
 @get('/api/users')
-async def api_get_users(*, page='1'):
+async def api_get_users(*, page='1', cursor=None):
+    if cursor is not None:
+        p = CursorPage(cursor)
+        users = p.paginate(await User.findAll(orderBy='created_at desc', after=p.after, limit=p.limit))
+        for u in users:
+            u.passwd = '******'
+        return dict(page=p, users=users)
     page_index = get_page_index(page)
     num = await User.findNumber('count(id)')
     p = Page(num, page_index)
@@ -310,36 +348,42 @@ async def api_register_user(*, email, name, passwd):
         raise APIValueError('email')
     if not passwd or not _RE_SHA1.match(passwd):
         raise APIValueError('passwd')
+    # 已有的数据库上不一定有email的唯一索引（schema.py --check会列出缺少的索引），建好之前仍要先查询
     users = await User.findAll('email=?', [email])
     if len(users) > 0:
         raise APIError('register:failed', 'email', 'Email is already in use.')
-
     uid = next_id()
     sha1_passwd = '%s:%s' % (uid, passwd)
     # gravatar用于提供头像，只需要构建URL
     # gravatar_url = "https://www.gravatar.com/avatar/" + hashlib.md5(email.lower()).hexdigest() + "?"
     # gravatar_url += urllib.urlencode({'d':default, 's':str(size)})
     user = User(id=uid, name=name.strip(), email=email, passwd=hashlib.sha1(sha1_passwd.encode('utf-8')).hexdigest(), image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email.encode('utf-8')).hexdigest())
-    await user.save()
+    # 有唯一索引时，并发注册同一个email的请求都通过了上面的查询，也只有一个能插入，其余的报唯一键冲突
+    # 不用insert ignore：MySQL的insert ignore会把超长截断等所有错误都变成警告
+    try:
+        await user.save()
+    except Exception as e:
+        if not backend().is_duplicate_key(e):
+            raise
+        raise APIError('register:failed', 'email', 'Email is already in use.')
 
     r = web.Response()
     # max_age是cookie的最大存活周期,单位是秒.当时间结束时,客户端将抛弃该cookie.之后需要重新登录.86400s即24h
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
     user.passwd = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = encoders.dumps(user)
     return r
 
 
 @get('/')
 async def index(*, page='1'):
     page_index = get_page_index(page)
-    num = await Blog.findNumber('count(id)')
+    # 总数和第一页并发查询，没有日志时丢弃查到的结果
+    num, blogs = await gather_queries(Blog.findNumber('count(id)'), Blog.findAll(orderBy='created_at desc', limit=Page.slice(1), columns=Blog.defer('content')))
     page = Page(num)
     if num == 0:
         blogs = []
-    else:
-        blogs = await Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit))
     return {
         '__template__': 'blogs.html',
         'page': page,
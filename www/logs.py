@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Logging for the hot paths: deferred formatting, per-category levels, request sampling
+and emission through a queue, so formatting and stdout I/O never run on the event loop.
+'''
+
+import logging, logging.handlers, queue, itertools, atexit
+from contextvars import ContextVar
+
+# 当前请求的序号，由logger_factory在请求开始时分配；不在请求内时为None，日志总是输出
+_request_seq = ContextVar('request_seq', default=None)
+__request_counter = itertools.count()
+
+# 各类别的采样率：n表示每n个请求记录1个，只对INFO及以下的级别生效，WARNING及以上总是输出
+__sample = dict()
+
+__listener = None
+
+class Logger(object):
+    '''
+    Category logger: logger = get_logger('sql'); logger.info('SQL: %s', sql, rows=3)
+    Message arguments and keyword fields are formatted by the listener thread, not the caller.
+    '''
+
+    def __init__(self, category):
+        self.category = category
+        self.logger = logging.getLogger('awesome.' + category)
+
+    def enabled(self, level):
+        ' check level and sampling before building any argument. '
+        if not self.logger.isEnabledFor(level):
+            return False
+        if level < logging.WARNING:
+            # 类里引用模块的__sample会被改名，通过函数取
+            n = _sample_rate(self.category)
+            if n > 1:
+                seq = _request_seq.get()
+                return seq is None or seq % n == 0
+        return True
+
+    def log(self, level, msg, *args, **fields):
+        if self.enabled(level):
+            self.logger.log(level, msg, *args, extra=dict(category=self.category, fields=fields))
+
+    def debug(self, msg, *args, **fields):
+        self.log(logging.DEBUG, msg, *args, **fields)
+
+    def info(self, msg, *args, **fields):
+        self.log(logging.INFO, msg, *args, **fields)
+
+    def warning(self, msg, *args, **fields):
+        self.log(logging.WARNING, msg, *args, **fields)
+
+    def error(self, msg, *args, **fields):
+        self.log(logging.ERROR, msg, *args, **fields)
+
+def _sample_rate(category):
+    return __sample.get(category, 1)
+
+def get_logger(category):
+    return Logger(category)
+
+def begin_request():
+    '''
+    Assign a sequence number to the current request for sampling, return a token for end_request().
+    '''
+    return _request_seq.set(next(__request_counter))
+
+def end_request(token):
+    _request_seq.reset(token)
+
+class StructuredFormatter(logging.Formatter):
+    ' append keyword fields as key=value pairs. '
+
+    def format(self, record):
+        s = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            s = '%s %s' % (s, ' '.join('%s=%r' % (k, v) for k, v in fields.items()))
+        return s
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    # 标准的QueueHandler在调用者线程里先格式化消息，这里直接放入记录，格式化留给监听线程
+    # 同一进程内的队列不需要pickle，参数对象原样传递，调用者不应再修改它们
+    def prepare(self, record):
+        return record
+
+def setup(level='INFO', levels=None, sample=None, format='%(levelname)s:%(name)s:%(message)s', queued=True):
+    '''
+    Configure root logging once at startup.
+
+    level: root level; levels: per-category levels, e.g. {'sql': 'WARNING'};
+    sample: per-category request sampling, e.g. {'request': 10} keeps 1 in 10 requests.
+    '''
+    global __listener
+    shutdown()
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.setLevel(level)
+    for category, lv in (levels or {}).items():
+        logging.getLogger('awesome.' + category).setLevel(lv)
+    __sample.clear()
+    __sample.update(sample or {})
+    handler = logging.StreamHandler()
+    handler.setFormatter(StructuredFormatter(format))
+    if queued:
+        # 后台线程负责格式化和写stdout，事件循环只把记录放进队列
+        q = queue.SimpleQueue()
+        root.addHandler(_QueueHandler(q))
+        __listener = logging.handlers.QueueListener(q, handler, respect_handler_level=True)
+        __listener.start()
+        # 监听线程是daemon线程，进程退出时队列里剩下的记录会丢失，退出前先输出完
+        atexit.unregister(shutdown)
+        atexit.register(shutdown)
+    else:
+        root.addHandler(handler)
+
+def shutdown():
+    '''
+    Flush queued records and stop the listener thread.
+    '''
+    global __listener
+    if __listener is not None:
+        __listener.stop()
+        __listener = None
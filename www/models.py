@@ -12,20 +12,24 @@ def next_id():
 # 这是一个用户名的表
 class User(Model):
     __table__ = 'users'
+    __counters__ = ()
 
     # 给一个Field增加一个default参数可以让ORM自己填入缺省值，非常方便。并且，缺省值可以作为函数对象传入，在调用save()时自动计算。
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    email = StringField(ddl='varchar(50)')
+    email = StringField(ddl='varchar(50)', unique=True)
     passwd = StringField(ddl='varchar(50)')
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(500)') # 头像
     # 日期和时间用float类型存储在数据库中，而不是datetime类型，这么做的好处是不必关心数据库的时区以及时区转换问题，排序非常简单，显示的时候，只需要做一个float到str的转换，也非常容易。
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
 
 # 这是一个博客的表
 class Blog(Model):
     __table__ = 'blogs'
+    # 日志的读远多于写，缓存查询结果
+    __cache__ = True
+    __counters__ = ()
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
@@ -34,11 +38,15 @@ class Blog(Model):
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
     content = TextField()
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
 
 # 这是一个评论的表
 class Comment(Model):
     __table__ = 'comments'
+    # 同时维护每篇日志的评论数
+    __counters__ = ('blog_id',)
+    # 日志详情页按blog_id查评论并按时间排序
+    __indexes__ = (('blog_id', 'created_at'),)
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     blog_id = StringField(ddl='varchar(50)')
@@ -46,5 +54,5 @@ class Comment(Model):
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     content = TextField()
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
     
\ No newline at end of file
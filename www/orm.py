@@ -1,30 +1,71 @@
 import logging
 import asyncio
-import aiomysql
+import time
+import bisect
+import re
+import hashlib
+from collections import OrderedDict, deque
+import contextvars
+import logs
+from backends import get_backend
+
+_logger = logs.get_logger('sql')
 
 def log(sql, args=()):
-    logging.info('SQL:%s' % sql)
+    _logger.info('SQL: %s', sql)
 
 async def create_pool(loop, **kw):
+    '''
+    Create the primary pool and optional read replica pools:
+    replicas is a list of dicts overriding the primary config (e.g. host),
+    replica_strategy is 'round-robin' or 'least-busy',
+    read_your_writes is the seconds reads in the same session go to primary after a write,
+    backend is 'mysql' or 'sqlite' (with path of the database file).
+    '''
     logging.info('create database connection pool...')
+    set_backend(kw.get('backend', 'mysql'))
     # 创建一个全局的连接池避免频繁关闭和打开数据库连接
     # 如果在局部要对全局变量修改，需要在局部也要先声明该变量为全局变量
-    global __pool
-    __pool = await aiomysql.create_pool(
-        host=kw.get('host', 'localhost'),
-        port=kw.get('port', 3306),
-        user=kw['user'],
-        password=kw['password'],
-        db=kw['db'],
-        charset=kw.get('charset', 'utf8'),
-        autocommit=kw.get('autocommit', True),  # 默认自动提交事务
-        maxsize=kw.get('maxsize', 10),          # 连接池最多同时处理10个请求
-        minsize=kw.get('minszie', 1),           # 连接池最少1个请求
-        loop=loop                               # 传递消息循环event_loop实例用于异步执行
-    )
+    global __pool, __replicas, __replica_strategy, __read_your_writes
+    __pool_stats.clear()
+    __pool = await _create_pool(loop, kw, 'primary')
+    # 只读副本的配置没写的项沿用主库的配置
+    __replicas = []
+    for n, replica in enumerate(kw.get('replicas', None) or []):
+        logging.info('create replica connection pool: %s' % replica.get('host', kw.get('host', 'localhost')))
+        __replicas.append(await _create_pool(loop, dict(kw, **replica), 'replica%s' % n))
+    __replica_strategy = kw.get('replica_strategy', 'round-robin')
+    if __replica_strategy not in ('round-robin', 'least-busy'):
+        raise ValueError('Invalid replica_strategy value: %s' % __replica_strategy)
+    __read_your_writes = kw.get('read_your_writes', 1.0)
+    __cache.configure(**kw.get('cache', None) or {})
+    __cache.clear()
+    __slow_log.configure(**kw.get('slow_log', None) or {})
+
+async def _create_pool(loop, kw, name):
+    pool = await __backend.create_pool(loop, kw)
+    stats = __pool_stats[pool] = PoolStats(name, pool)
+    # 自适应模式：可用的连接数在minsize和maxsize之间根据等待时间和使用率自动伸缩
+    if kw.get('adaptive', False):
+        stats.limiter = AdaptiveLimiter(pool, stats, kw.get('minsize', 1), kw.get('maxsize', 10), interval=kw.get('adapt_interval', 10.0))
+        stats.limiter.start()
+    return pool
 
 async def destroy_pool():  
     global __pool  
+    # 只有start_counters()建立了counters表，也只有这时才需要持久化
+    started = __counters_task is not None
+    stop_counters()
+    if started and __pool is not None:
+        # 上次校正后计数的变化还没有持久化，关闭连接池前写入counters表
+        try:
+            await flush_counters()
+        except Exception as e:
+            logging.exception(e)
+    dump_slow_queries()
+    for stats in __pool_stats.values():
+        if stats.limiter is not None:
+            stats.limiter.stop()
     if __pool is not None:
         # Mark all pool connections to be closed on getting back to pool. 
         # Closed pool doesn’t allow to acquire new connections.
@@ -34,53 +75,824 @@ async def destroy_pool():
         # please call wait_closed() after close().
         # wait_close()方法是一个协程   
         await __pool.wait_closed() 
+    for replica in __replicas:
+        replica.close()
+        await replica.wait_closed()
+
+# 当前使用的数据库后端，负责连接池、游标、事务和SQL方言
+__backend = get_backend('mysql')
+
+def backend():
+    '''
+    Return the current database backend.
+    '''
+    return __backend
+
+def set_backend(name):
+    '''
+    Switch database backend by name, statements cached by models are recompiled for it.
+    '''
+    global __backend
+    if name == __backend.name:
+        return
+    __backend = get_backend(name)
+    # Model缓存的语句已经转换成了旧后端的占位符，全部重新生成
+    for model in models():
+        model.__statements__.clear()
+        model._compile_statements()
+    __cache.clear()
+
+__pool = None
+__replicas = []
+__replica_strategy = 'round-robin'
+__read_your_writes = 1.0
+__replica_index = 0
+
+# 从只读副本中选一个连接池：轮询，或者选正在使用的连接最少的
+def _replica():
+    global __replica_index
+    if __replica_strategy == 'least-busy':
+        return min(__replicas, key=lambda p: p.size - p.freesize)
+    __replica_index = (__replica_index + 1) % len(__replicas)
+    return __replicas[__replica_index]
+
+# 读自己的写：同一个会话写入后的一小段时间内，读请求仍然发到主库，避免副本延迟导致读不到刚写的数据
+# 会话由orm.session(key)指定（如登录用户的id），没有指定时只在当前请求内生效
+_session = contextvars.ContextVar('session', default=None)
+__session_writes = dict()
+
+class Session(object):
+    ' scope of read-your-writes tracking, use as: with orm.session(key): ... '
+
+    def __init__(self, key=None):
+        # 没有key时用对象本身作为key，只在with块内有效
+        self.key = self if key is None else key
+
+    def __enter__(self):
+        self._token = _session.set(self.key)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _session.reset(self._token)
+
+def session(key=None):
+    return Session(key)
+
+def _record_write():
+    key = _session.get()
+    if key is None or not __replicas:
+        return
+    now = time.monotonic()
+    writes = __session_writes
+    writes.pop(key, None)
+    writes[key] = now
+    # dict按插入顺序排列，最早的写入在最前面，顺便清理已经过期的记录
+    for k in list(writes):
+        if now - writes[k] <= __read_your_writes:
+            break
+        del writes[k]
+
+def _recently_written():
+    key = _session.get()
+    if key is None:
+        return False
+    t = __session_writes.get(key)
+    return t is not None and time.monotonic() - t <= __read_your_writes
+
+# 连接池和语句的统计：等待连接的耗时分布、正在使用和空闲的连接数、排队等待的协程数，
+# 以及每条语句的执行次数、耗时和行数，通过pool_stats()或/manage/stats/pool查看
+class Histogram(object):
+    ' histogram of durations in seconds with fixed buckets. '
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.count = self.count + 1
+        self.sum = self.sum + value
+        if value > self.max:
+            self.max = value
+
+    def to_dict(self):
+        buckets = [('%g' % b, c) for b, c in zip(self.BUCKETS, self.counts)]
+        buckets.append(('+Inf', self.counts[-1]))
+        return dict(count=self.count, sum=self.sum, max=self.max, buckets=buckets)
+
+class PoolStats(object):
+    ' acquire latency and saturation of one connection pool. '
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.acquire_wait = Histogram()
+        self.waiting = 0
+        self.max_waiting = 0
+        self.limiter = None
+
+    def to_dict(self):
+        pool = self.pool
+        limit = pool.maxsize if self.limiter is None else self.limiter.limit
+        return dict(name=self.name, size=pool.size, free=pool.freesize, in_use=pool.size - pool.freesize, maxsize=pool.maxsize, limit=limit, waiting=self.waiting, max_waiting=self.max_waiting, acquire_wait=self.acquire_wait.to_dict())
+
+class AdaptiveLimiter(object):
+    '''
+    Limit connections in use of a pool to a limit between minsize and maxsize,
+    grow the limit when acquires wait and shrink it when the pool is underused.
+    '''
+
+    def __init__(self, pool, stats, minsize, maxsize, interval=10.0, grow_wait=0.005, shrink_usage=0.5):
+        self.pool = pool
+        self.stats = stats
+        self.minsize = max(minsize, 1)
+        self.maxsize = max(maxsize, self.minsize)
+        self.interval = interval
+        self.grow_wait = grow_wait
+        self.shrink_usage = shrink_usage
+        self.limit = self.minsize
+        self.in_use = 0
+        self.peak = 0
+        self._cond = asyncio.Condition()
+        self._last_count = 0
+        self._last_sum = 0.0
+        self._task = None
+
+    async def enter(self):
+        async with self._cond:
+            while self.in_use >= self.limit:
+                await self._cond.wait()
+            self.in_use = self.in_use + 1
+            if self.in_use > self.peak:
+                self.peak = self.in_use
+
+    async def leave(self):
+        async with self._cond:
+            self.in_use = self.in_use - 1
+            self._cond.notify()
+
+    async def adjust(self):
+        ' adjust limit by the acquire wait and usage since last adjust. '
+        h = self.stats.acquire_wait
+        count, total = h.count - self._last_count, h.sum - self._last_sum
+        self._last_count, self._last_sum = h.count, h.sum
+        avg_wait = total / count if count else 0.0
+        usage = self.peak / self.limit
+        self.peak = self.in_use
+        if (avg_wait > self.grow_wait or self.stats.waiting > 0) and self.limit < self.maxsize:
+            # 排队等连接了，成倍放大，尽快追上流量
+            self.limit = min(self.maxsize, self.limit * 2)
+            logging.info('pool %s grows to %s connections, avg acquire wait: %.4fs' % (self.stats.name, self.limit, avg_wait))
+            async with self._cond:
+                self._cond.notify_all()
+        elif usage < self.shrink_usage and self.limit > self.minsize:
+            # 用不了一半就缩小，但不低于这段时间的峰值
+            self.limit = max(self.minsize, self.limit // 2, self.peak)
+            logging.info('pool %s shrinks to %s connections, usage: %.2f' % (self.stats.name, self.limit, usage))
+            # 只关闭超出限制的空闲连接，limit不小于minsize，预先建立的连接都会保留；正在使用的连接归还后仍然可以复用
+            if self.pool.size > self.limit:
+                await backend().close_idle(self.pool, self.pool.size - self.limit)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.adjust()
+            except Exception as e:
+                logging.exception(e)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+class StatementStats(object):
+    ' execution time and row counts of one statement. '
+
+    def __init__(self):
+        self.duration = Histogram()
+        self.rows = 0
+
+    def to_dict(self):
+        return dict(duration=self.duration.to_dict(), rows=self.rows)
+
+__pool_stats = dict()
+__statement_stats = dict()
+# 语句按SQL文本统计，超过上限的语句合并到'other'里，避免拼接了参数的SQL把内存撑爆
+MAX_STATEMENT_STATS = 500
+
+# 包装pool.get()，统计等待连接的时间和排队的协程数
+class _InstrumentedAcquire(object):
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._stats = _stats_of(pool)
+
+    async def __aenter__(self):
+        stats = self._stats
+        limiter = stats.limiter
+        stats.waiting = stats.waiting + 1
+        if stats.waiting > stats.max_waiting:
+            stats.max_waiting = stats.waiting
+        start = time.perf_counter()
+        try:
+            if limiter is not None:
+                await limiter.enter()
+            try:
+                self._ctx = self._pool.get()
+                conn = await self._ctx.__aenter__()
+            except BaseException as e:
+                if limiter is not None:
+                    await limiter.leave()
+                raise
+        finally:
+            stats.waiting = stats.waiting - 1
+        stats.acquire_wait.observe(time.perf_counter() - start)
+        return conn
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        try:
+            return (await self._ctx.__aexit__(exc_type, exc_value, traceback))
+        finally:
+            if self._stats.limiter is not None:
+                await self._stats.limiter.leave()
+
+def _stats_of(pool):
+    return __pool_stats[pool]
+
+def _record_statement(sql, args, duration, rows):
+    if __slow_log.threshold is not None and duration >= __slow_log.threshold:
+        __slow_log.record(sql, args, duration, rows)
+    stats = __statement_stats.get(sql)
+    if stats is None:
+        if len(__statement_stats) >= MAX_STATEMENT_STATS:
+            sql = 'other'
+            stats = __statement_stats.get(sql)
+        if stats is None:
+            stats = __statement_stats[sql] = StatementStats()
+    stats.duration.observe(duration)
+    if rows > 0:
+        stats.rows = stats.rows + rows
+    return stats
+
+# 慢查询日志：执行时间超过阈值的语句记录SQL、参数的指纹（不保存参数本身）、耗时、行数，
+# select语句另外在后台执行EXPLAIN并保存结果；只保留最近的size条，通过/manage/stats/slow查看，关闭连接池时输出到日志
+# 慢查询往往在连接池已经很忙时集中出现，所以同一条SQL在explain_ttl秒内只EXPLAIN一次，复用上次的结果，
+# 并且同一时间只执行一个EXPLAIN，正在执行时新的慢查询不再EXPLAIN
+class SlowQueryLog(object):
+    ' bounded ring buffer of statements slower than threshold seconds. '
+
+    def __init__(self, threshold=0.2, size=200, explain=True, explain_ttl=600.0):
+        self.entries = deque(maxlen=size)
+        self._plans = dict()
+        self._explaining = False
+        self.configure(threshold, size, explain, explain_ttl)
+
+    def configure(self, threshold=0.2, size=200, explain=True, explain_ttl=600.0):
+        self.threshold = threshold
+        self.explain = explain
+        self.explain_ttl = explain_ttl
+        if size != self.entries.maxlen:
+            self.entries = deque(self.entries, maxlen=size)
+
+    def record(self, sql, args, duration, rows):
+        args = tuple(args) if args else ()
+        entry = dict(time=time.time(), sql=sql, args_fingerprint=hashlib.md5(repr(args).encode('utf-8')).hexdigest()[:12], args_count=len(args), duration=duration, rows=rows, explain=None)
+        self.entries.append(entry)
+        logging.warning('slow query %.3fs, %s rows: %s' % (duration, rows, sql))
+        if self.explain and sql.lstrip()[:6].lower() == 'select':
+            plan = self._plans.get(sql)
+            if plan is not None and plan[0] > time.monotonic():
+                entry['explain'] = plan[1]
+            elif not self._explaining:
+                self._explaining = True
+                asyncio.ensure_future(self._run_explain(entry, sql, args))
+
+    async def _run_explain(self, entry, sql, args):
+        try:
+            entry['explain'] = await _explain(sql, args)
+        finally:
+            self._explaining = False
+        # 按SQL保存最近的结果，条数不超过日志的条数
+        self._plans.pop(sql, None)
+        if len(self._plans) >= self.entries.maxlen:
+            del self._plans[next(iter(self._plans))]
+        self._plans[sql] = (time.monotonic() + self.explain_ttl, entry['explain'])
+
+    def clear(self):
+        self.entries.clear()
+        self._plans.clear()
+
+__slow_log = SlowQueryLog()
+
+# EXPLAIN在单独的任务里执行，不占用原来的连接，也不计入语句统计
+# 直接从连接池取连接，不经过自适应限流，不计入连接池的统计
+async def _explain(sql, args):
+    # 任务复制了调用者的上下文，清掉事务，避免与事务并发使用同一个连接
+    _transaction.set(None)
+    try:
+        async with (_replica() if __replicas else __pool).get() as conn:
+            async with conn.cursor(__backend.DictCursor) as cur:
+                await cur.execute(__backend.explain_sql(sql), args)
+                return (await cur.fetchall())
+    except Exception as e:
+        return 'explain failed: %s' % e
+
+def slow_queries():
+    '''
+    Return recorded slow queries, the latest last.
+    '''
+    return list(__slow_log.entries)
+
+def slow_queries_text():
+    '''
+    Return recorded slow queries as plain text.
+    '''
+    L = []
+    for e in __slow_log.entries:
+        L.append('%s %.6fs rows=%s args=%s(%s) %s' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(e['time'])), e['duration'], e['rows'], e['args_fingerprint'], e['args_count'], e['sql']))
+        if isinstance(e['explain'], list):
+            for r in e['explain']:
+                L.append('    explain: %s' % ', '.join('%s=%s' % (k, v) for k, v in r.items()))
+        elif e['explain'] is not None:
+            L.append('    %s' % e['explain'])
+    return '\n'.join(L) + '\n'
+
+def dump_slow_queries():
+    '''
+    Write recorded slow queries to log.
+    '''
+    if __slow_log.entries:
+        logging.warning('slow queries:\n%s' % slow_queries_text())
+
+def pool_stats():
+    '''
+    Return stats of connection pools and statements as dict.
+    '''
+    return dict(
+        pools=[s.to_dict() for s in __pool_stats.values()],
+        statements=dict((sql, s.to_dict()) for sql, s in __statement_stats.items())
+    )
+
+def pool_stats_text():
+    '''
+    Return stats of connection pools and statements as plain text, one metric per line.
+    '''
+    L = []
+    for p in __pool_stats.values():
+        d = p.to_dict()
+        for k in ('size', 'in_use', 'free', 'maxsize', 'limit', 'waiting', 'max_waiting'):
+            L.append('pool_%s{pool="%s"} %s' % (k, d['name'], d[k]))
+        _histogram_lines(L, 'pool_acquire_wait_seconds', 'pool="%s"' % d['name'], d['acquire_wait'])
+    for sql, s in __statement_stats.items():
+        label = 'sql="%s"' % sql.replace('\\', '\\\\').replace('"', '\\"')
+        _histogram_lines(L, 'statement_duration_seconds', label, s.duration.to_dict())
+        L.append('statement_rows{%s} %s' % (label, s.rows))
+    return '\n'.join(L) + '\n'
+
+def _histogram_lines(L, name, label, h):
+    total = 0
+    for le, c in h['buckets']:
+        total = total + c
+        L.append('%s_bucket{%s,le="%s"} %s' % (name, label, le, total))
+    L.append('%s_count{%s} %s' % (name, label, h['count']))
+    L.append('%s_sum{%s} %.6f' % (name, label, h['sum']))
+    L.append('%s_max{%s} %.6f' % (name, label, h['max']))
 
-async def select(sql, args, size=None):
+# 查询结果缓存：按(SQL, 参数)缓存select的结果行，LRU + TTL淘汰，总条目数和总行数都有上限
+# 只缓存打开了__cache__的Model的查询（或者调用select时指定了cache表名），对该表的写入会让该表的缓存全部失效
+# 每个表有一个版本号，每次失效加1；查询前记下版本号，查询结束时版本号变了说明期间有写入，结果不缓存
+class QueryCache(object):
+    ' LRU and TTL cache of select results with invalidation by table. '
+
+    def __init__(self, ttl=60.0, max_entries=1000, max_rows=100000):
+        self.configure(ttl, max_entries, max_rows)
+        self._entries = OrderedDict()
+        self._tables = dict()
+        self._generations = dict()
+        # clear()时加1，让所有表的版本号都失效
+        self._epoch = 0
+        # 各表最后一次失效的时间
+        self._invalidated_at = dict()
+        self.rows = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def configure(self, ttl=60.0, max_entries=1000, max_rows=100000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses = self.misses + 1
+            return None
+        expires, table, rs = entry
+        if expires < time.monotonic():
+            self._pop(key)
+            self.misses = self.misses + 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits = self.hits + 1
+        return rs
+
+    def generation(self, table):
+        return (self._epoch, self._generations.get(table, 0))
+
+    def invalidated_within(self, table, seconds):
+        t = self._invalidated_at.get(table)
+        return t is not None and time.monotonic() - t <= seconds
+
+    def put(self, key, table, rs, generation=None):
+        # 单个结果集超过总行数上限的不缓存
+        if len(rs) > self.max_rows:
+            return
+        if generation is not None and generation != self.generation(table):
+            return
+        self._pop(key)
+        self._entries[key] = (time.monotonic() + self.ttl, table, rs)
+        self._tables.setdefault(table, set()).add(key)
+        self.rows = self.rows + len(rs)
+        while len(self._entries) > self.max_entries or self.rows > self.max_rows:
+            self._pop(next(iter(self._entries)))
+            self.evictions = self.evictions + 1
+
+    def invalidate(self, table):
+        self._generations[table] = self._generations.get(table, 0) + 1
+        self._invalidated_at[table] = time.monotonic()
+        keys = self._tables.pop(table, None)
+        if keys:
+            for key in keys:
+                expires, t, rs = self._entries.pop(key)
+                self.rows = self.rows - len(rs)
+            self.invalidations = self.invalidations + len(keys)
+
+    def clear(self):
+        self._entries.clear()
+        self._tables.clear()
+        self._generations.clear()
+        self._invalidated_at.clear()
+        self._epoch = self._epoch + 1
+        self.rows = 0
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            expires, table, rs = entry
+            self.rows = self.rows - len(rs)
+            keys = self._tables.get(table)
+            keys.discard(key)
+            if not keys:
+                del self._tables[table]
+
+    def to_dict(self):
+        total = self.hits + self.misses
+        return dict(entries=len(self._entries), rows=self.rows, hits=self.hits, misses=self.misses, hit_rate=self.hits / total if total else 0.0, evictions=self.evictions, invalidations=self.invalidations)
+
+__cache = QueryCache()
+
+def cache_stats():
+    '''
+    Return hit and miss rates and size of the query cache as dict.
+    '''
+    return __cache.to_dict()
+
+def cache_stats_text():
+    '''
+    Return stats of the query cache as plain text, one metric per line.
+    '''
+    return ''.join('query_cache_%s %s\n' % (k, v) for k, v in sorted(__cache.to_dict().items()))
+
+# 类的定义体里不能直接写__cache，Transaction通过这个函数让缓存失效
+def _invalidate_cache(table):
+    __cache.invalidate(table)
+
+# 表被写入后让该表的缓存失效；事务内的写入在提交或回滚时会再失效一次，
+# 避免事务结束前其他请求又把旧数据放进缓存
+def _invalidate(table):
+    __cache.invalidate(table)
+    tx = _transaction.get()
+    if tx is not None:
+        tx.tables.add(table)
+
+_RE_WRITE_TABLE = re.compile(r'^\s*(?:insert\s+(?:ignore\s+|or\s+\w+\s+)?into|update|delete\s+from|replace\s+into)\s+`?(\w+)`?', re.IGNORECASE)
+
+# 直接调用execute()时从SQL里解析出被写入的表
+def _written_table(sql):
+    m = _RE_WRITE_TABLE.match(sql)
+    return m.group(1) if m else None
+
+# SQL语句的占位符是?，由后端转换为驱动的占位符（MySQL是%s）
+# Model的语句在ModelMetaclass中预先转换好并缓存，只有直接调用select/execute时才需要每次替换
+def _driver_sql(sql):
+    return __backend.driver_sql(sql)
+
+# cache为表名时，结果按该表缓存，该表被写入时失效
+async def select(sql, args, size=None, cache=None):
+    if cache:
+        # 规范化空白，写法不同但内容相同的SQL共用缓存
+        sql = ' '.join(sql.split())
+    return (await _select(_driver_sql(sql), args, size, cache))
+
+# _select()与_execute()接收的是已经转换为驱动占位符的SQL，Model的热路径直接调用它们
+# raw为True时用普通游标，每一行是tuple而不是dict
+# primary为True时即使有只读副本也从主库读
+async def _select(sql, args, size=None, cache=None, raw=False, primary=False):
+    # 事务内的读要看到本事务未提交的写，不使用缓存
+    if cache and _transaction.get() is None:
+        key = (sql, tuple(args) if args else (), size, raw)
+        rs = __cache.get(key)
+        if rs is not None:
+            return list(rs)
+        # 先记下表的版本，查询期间表被写入时结果可能是旧的，不放进缓存
+        generation = __cache.generation(cache)
+        # 表刚被写入时副本可能还没有同步，从副本读到的旧数据会在缓存里保留ttl秒，这段时间从主库读
+        primary = bool(__replicas) and __cache.invalidated_within(cache, __read_your_writes)
+        rs = await _select(sql, args, size, None, raw, primary)
+        __cache.put(key, cache, rs, generation)
+        return list(rs)
     log(sql, args)
-    global __pool
     # 异步等待连接池对象返回可以连接线程，with语句则封装了清理（关闭conn）和处理异常的工作
-    async with __pool.get() as conn:
+    async with _acquire(readonly=not primary) as conn:
         # 打开一个DictCursor,它与普通游标的不同在于,以dict形式返回结果
         # 即原来返回类似的tuple结果集合 ((1000L, 0L), (2000L, 0L), (3000L, 0L))
         # 现在返回dict结果集合 ({'user_id': 0L, 'blog_id': 1000L}, {'user_id': 0L, 'blog_id': 2000L}, {'user_id': 0L, 'blog_id': 3000L})
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            # SQL语句的占位符是?，而MySQL的占位符是%s, 这里要做一下替换,
+        start = time.perf_counter()
+        async with conn.cursor(__backend.Cursor if raw else __backend.DictCursor) as cur:
             # args是sql语句对应占位符的参数
-            await cur.execute(sql.replace('?', '%s'), args or ())
+            await cur.execute(sql, args or ())
             if size:
                 # 获取指定数量（可能小于）的记录
                 rs = await cur.fetchmany(size)
             else:
                 # 获取所有记录
                 rs = await cur.fetchall()
-        logging.info('rows returned: %s' % len(rs))
+        _record_statement(sql, args, time.perf_counter() - start, len(rs))
+        _logger.info('rows returned: %s', len(rs))
         return rs
 
+# 流式读取结果集：用非缓冲的SSDictCursor每次从服务器取size行，整个结果集不会一次性放进内存
+# 迭代期间一直占用一个连接，提前结束迭代时应该用aclose()关闭生成器以尽快归还连接
+async def _iter_select(sql, args, size):
+    log(sql, args)
+    async with _acquire(readonly=True) as conn:
+        start = time.perf_counter()
+        rows = 0
+        async with conn.cursor(__backend.SSDictCursor) as cur:
+            await cur.execute(sql, args or ())
+            # 流式读取的耗时只统计执行语句的部分，不包括调用者处理每一行的时间
+            stats = _record_statement(sql, args, time.perf_counter() - start, 0)
+            while True:
+                rs = await cur.fetchmany(size)
+                if not rs:
+                    break
+                rows = rows + len(rs)
+                for r in rs:
+                    yield r
+        stats.rows = stats.rows + rows
+
 # execute()函数和select()函数所不同的是，cursor对象不返回结果集
 # 而是通过rowcount返回结果数（操作影响的行号）
 # 适用于INSERT、UPDATE、DELETE语句
 async def execute(sql, args, autocommit=True):
+    return (await _execute(_driver_sql(sql), args, autocommit, _written_table(sql)))
+
+# table为被写入的表，用于让查询缓存失效
+async def _execute(sql, args, autocommit=True, table=None):
     log(sql)
-    async with __pool.get() as conn:
-        if not autocommit:
+    # 已经在transaction()块中时由外层事务负责提交或回滚
+    standalone = not autocommit and _transaction.get() is None
+    _record_write()
+    async with _acquire() as conn:
+        if standalone:
             await conn.begin()
         try:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql.replace('?', '%s'), args)
+            start = time.perf_counter()
+            async with conn.cursor(__backend.DictCursor) as cur:
+                await cur.execute(sql, args)
                 # 返回受影响的行数
                 affected = cur.rowcount
-            if not autocommit:
+            _record_statement(sql, args, time.perf_counter() - start, affected)
+            if standalone:
                 await conn.commit()
         except BaseException as e:
-            if not autocommit:
+            if standalone:
                 await conn.rollback()
             # raise不带参数，则把此处的错误往上抛
             raise
+        finally:
+            # 写入完成后才让缓存失效：写入期间发出的读可能读到旧数据，失效后它们的结果不再放进缓存
+            if table is not None:
+                _invalidate(table)
         #finally:
             # 执行完SQL语句，释放与数据库的连接，否则event loop is closed错误
             #conn.close()
         return affected
 
+# 在同一个事务里依次执行多条语句，任何一条失败都整体回滚
+# batches是(sql, args)的序列，sql已经转换为驱动占位符，返回受影响的总行数
+async def _execute_batch(batches, table=None):
+    async with transaction():
+        affected = 0
+        for sql, args in batches:
+            affected += await _execute(sql, args, table=table)
+        return affected
+
+# 当前协程所在的事务，事务内的select/execute以及Model的方法都通过它固定使用同一个连接
+_transaction = contextvars.ContextVar('transaction', default=None)
+
+# 事务内直接使用固定的连接，退出with块时不归还给连接池
+class _PinnedConnection(object):
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    async def __aenter__(self):
+        return self._conn
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        return False
+
+# readonly的语句在没有事务、会话最近也没有写入时发往只读副本，其余都发往主库
+def _acquire(readonly=False):
+    tx = _transaction.get()
+    if tx is not None and tx.conn is not None:
+        return _PinnedConnection(tx.conn)
+    if readonly and __replicas and not _recently_written():
+        return _InstrumentedAcquire(_replica())
+    return _InstrumentedAcquire(__pool)
+
+# 类的定义体里写__pool会被改名为_类名__pool，所以Transaction通过这个函数从连接池取连接
+def _acquire_new():
+    return _InstrumentedAcquire(__pool)
+
+class Transaction(object):
+    '''
+    Transaction on one pinned connection, used as:
+    async with orm.transaction() as tx: ...
+    commit when the block exits normally, rollback when it raises.
+    '''
+
+    def __init__(self):
+        self.conn = None
+        self._outer = None
+        self._rollback_only = False
+        # 事务内写过的表
+        self.tables = set()
+
+    async def __aenter__(self):
+        outer = _transaction.get()
+        if outer is not None and outer.conn is not None:
+            # 嵌套的transaction()加入外层事务，不单独提交
+            self._outer = outer
+            return outer
+        self._ctx = _acquire_new()
+        self.conn = await self._ctx.__aenter__()
+        try:
+            await self.conn.begin()
+        except BaseException as e:
+            await self._ctx.__aexit__(type(e), e, e.__traceback__)
+            raise
+        self._token = _transaction.set(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if self._outer is not None:
+            # 异常穿过内层块时，整个事务只能回滚
+            if exc_type is not None:
+                self._outer._rollback_only = True
+            return False
+        try:
+            if self.conn is not None:
+                if exc_type is None and not self._rollback_only:
+                    await self.commit()
+                else:
+                    await self.rollback()
+        finally:
+            _transaction.reset(self._token)
+            await self._ctx.__aexit__(exc_type, exc_value, traceback)
+        return False
+
+    async def commit(self):
+        ' commit now, statements after it in the block no longer use the pinned connection. '
+        conn, self.conn = self.conn, None
+        if conn is not None:
+            await conn.commit()
+            self._invalidate_tables()
+
+    async def rollback(self):
+        ' rollback now, statements after it in the block no longer use the pinned connection. '
+        conn, self.conn = self.conn, None
+        if conn is not None:
+            await conn.rollback()
+            # 事务内对计数器做的增减随着回滚作废，只能丢掉这些表的计数，等下次查询或校正时重新计算
+            for table in self.tables:
+                _drop_counters(table)
+            self._invalidate_tables()
+            # 回滚后identity map里的对象可能与数据库不一致，全部丢弃
+            imap = _identity_map.get()
+            if imap is not None:
+                imap.clear()
+
+    def _invalidate_tables(self):
+        for table in self.tables:
+            _invalidate_cache(table)
+        self.tables.clear()
+
+def transaction():
+    return Transaction()
+
+# 并发执行互不依赖的查询，每条查询从连接池各取一个连接
+async def gather_queries(*aws, limit=None):
+    '''
+    Run independent queries concurrently and return their results in order:
+    blog, comments = await orm.gather_queries(Blog.find(id), Comment.findAll('blog_id=?', [id]))
+    At most limit queries run at once (default half of the pool size). If any query fails,
+    the others are cancelled and the error is raised. In a transaction they run one by one.
+    '''
+    if _transaction.get() is not None:
+        # 事务里的语句都使用同一个固定的连接，不能并发
+        results = []
+        try:
+            for aw in aws:
+                results.append(await aw)
+        finally:
+            # 出错时关闭后面还没有执行的协程，避免never awaited的警告
+            for aw in aws[len(results) + 1:]:
+                if asyncio.iscoroutine(aw):
+                    aw.close()
+        return results
+    if limit is None:
+        limit = max(1, _pool_size() // 2)
+    sem = asyncio.Semaphore(limit)
+
+    async def run(aw):
+        async with sem:
+            return (await aw)
+
+    tasks = [asyncio.ensure_future(run(aw)) for aw in aws]
+    try:
+        return list(await asyncio.gather(*tasks))
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        # 等待被取消的查询结束，归还它们占用的连接
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+def _pool_size():
+    return __pool.maxsize if __pool is not None else 1
+
+# 请求级别的identity map：同一个请求里按主键多次find同一行时，直接返回内存里的同一个对象
+# 用contextvar保存，每个请求（协程任务）各自独立，不会串到别的请求
+_identity_map = contextvars.ContextVar('identity_map', default=None)
+
+class IdentityMap(object):
+    ' models loaded in current request, keyed by model class and primary key. '
+
+    def __init__(self):
+        self._objects = dict()
+
+    def get(self, cls, pk):
+        return self._objects.get((cls, pk))
+
+    def add(self, obj):
+        self._objects[(obj.__class__, obj.getValue(obj.__primary_key__))] = obj
+
+    def discard(self, cls, pk):
+        self._objects.pop((cls, pk), None)
+
+    # 批量更新或删除时不知道具体影响了哪些行，只能丢掉该Model的全部对象
+    def discard_model(self, cls):
+        for key in [k for k in self._objects if k[0] is cls]:
+            del self._objects[key]
+
+    def clear(self):
+        self._objects.clear()
+
+    # with identity_map(): ... 在with块内安装一个新的identity map，退出时丢弃
+    def __enter__(self):
+        self._token = _identity_map.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _identity_map.reset(self._token)
+        self.clear()
+
+def identity_map():
+    return IdentityMap()
+
 # insert插入属性时候，增加num个数量的占位符'?'
 # 比如说：insert into  `User` (`password`, `email`, `name`, `id`) values (?,?,?,?) 后面这四个问号
 def create_args_string(num):
@@ -89,6 +901,133 @@ def create_args_string(num):
         L.append('?')
     return ', '.join(L)
 
+# 按表名登记所有的Model，供计数器校正等需要从表名找到Model的地方使用
+__models = dict()
+
+def _register_model(model):
+    __models[model.__table__] = model
+
+def _model_of(table):
+    return __models.get(table)
+
+def models():
+    '''
+    Return all defined models.
+    '''
+    return list(__models.values())
+
+# 合并并发的find：同一轮事件循环里对同一个Model的find(pk)先登记下来，
+# 在下一轮统一发出一条 select ... where pk in (...)，再把结果分发给各个等待的协程，相同的主键只查一次
+class FindLoader(object):
+    '''
+    Coalesce find(pk) calls of one model in the same event loop tick into one query.
+    Callers share the query, cancelling one of them does not cancel the others:
+    >>> class Item(Model):
+    ...     __table__ = 'items'
+    ...     id = StringField(primary_key=True)
+    ...     @classmethod
+    ...     async def _findRows(cls, pks):
+    ...         await asyncio.sleep(0.01)
+    ...         return [dict(id=pk) for pk in pks]
+    >>> async def cancel_one():
+    ...     a, b = asyncio.ensure_future(Item.find('1')), asyncio.ensure_future(Item.find('1'))
+    ...     await asyncio.sleep(0)
+    ...     a.cancel()
+    ...     return await b
+    >>> asyncio.run(cancel_one())
+    {'id': '1'}
+    '''
+
+    def __init__(self, model, loop):
+        self.model = model
+        self.loop = loop
+        self._pending = dict()
+
+    def load(self, pk):
+        fut = self._pending.get(pk)
+        if fut is None:
+            if not self._pending:
+                self.loop.call_soon(self._dispatch)
+            fut = self._pending[pk] = self.loop.create_future()
+        return fut
+
+    def _dispatch(self):
+        pending, self._pending = self._pending, dict()
+        asyncio.ensure_future(self._fetch(pending))
+
+    async def _fetch(self, pending):
+        pk_name = self.model.__primary_key__
+        try:
+            rows = await self.model._findRows(list(pending))
+        except BaseException as e:
+            # 一批查询失败时，所有等待的协程都得到同一个异常
+            for fut in pending.values():
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        found = dict((r[pk_name], r) for r in rows)
+        for pk, fut in pending.items():
+            if not fut.done():
+                fut.set_result(found.get(pk))
+
+__loaders = dict()
+
+def _loader_of(model):
+    loop = asyncio.get_event_loop()
+    loader = __loaders.get(model)
+    if loader is None or loader.loop is not loop:
+        loader = __loaders[model] = FindLoader(model, loop)
+    return loader
+
+def _discard_model(cls):
+    imap = _identity_map.get()
+    if imap is not None:
+        imap.discard_model(cls)
+
+# 只读的行对象：findAll(raw=True)直接用返回tuple的游标构造，不经过dict
+# 各列保存在__slots__里，没有__dict__，比Model对象（dict加上游标返回的dict）省内存，构造和访问属性也更快
+class Row(object):
+    ' read-only row of a model, attributes are the selected columns. '
+
+    __slots__ = ()
+
+    def __setattr__(self, key, value):
+        raise AttributeError('%s is read-only' % self.__class__.__name__)
+
+    def __delattr__(self, key):
+        raise AttributeError('%s is read-only' % self.__class__.__name__)
+
+    # 兼容按dict方式取值的代码，如row['name']
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % (k, getattr(self, k)) for k in self.__slots__))
+
+    def __eq__(self, other):
+        return self.__class__ is other.__class__ and all(getattr(self, k) == getattr(other, k) for k in self.__slots__)
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, k) for k in self.__slots__))
+
+    def _asdict(self):
+        ' return columns as a dict, used by JSON serialization. '
+        return {k: getattr(self, k) for k in self.__slots__}
+
+# 按列名生成Row的子类。与namedtuple一样生成__init__的代码：按位置接收每一列，
+# 直接调用slot描述符的__set__赋值，绕过只读的__setattr__，比循环赋值快得多
+def _row_class(name, names):
+    cls = type(name, (Row,), dict(__slots__=tuple(names)))
+    namespace = dict(('_set%d' % i, getattr(cls, n).__set__) for i, n in enumerate(names))
+    params = ', '.join('_%d' % i for i in range(len(names)))
+    body = '\n'.join('    _set%d(self, _%d)' % (i, i) for i in range(len(names)))
+    exec('def __init__(self, %s):\n%s\n' % (params, body), namespace)
+    cls.__init__ = namespace['__init__']
+    return cls
+
 # 任何继承自Model的类（比如User），会自动通过ModelMetaclass扫描映射关系，并存储到自身的类属性如__table__、__mappings__中
 class ModelMetaclass(type):
 
@@ -140,13 +1079,46 @@ class ModelMetaclass(type):
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
-        return type.__new__(cls, name, bases, attrs)
+        # 与__select__的列顺序一致的只读行类
+        attrs['__row__'] = _row_class('%sRow' % name, [primaryKey] + fields)
+        # 索引：字段上声明的index/unique，加上__indexes__里声明的组合索引，如__indexes__ = (('blog_id', 'created_at'),)
+        # 统一保存为(索引名, 是否唯一, 列名tuple)的list
+        keys = []
+        for k, v in mappings.items():
+            if v.unique or v.index:
+                keys.append(('%s_%s' % ('uniq' if v.unique else 'idx', k), bool(v.unique), (v.name or k,)))
+        for columns in attrs.get('__indexes__', ()):
+            for k in columns:
+                if k not in mappings:
+                    raise RuntimeError('Index field not found: %s' % k)
+            keys.append(('idx_%s' % '_'.join(columns), False, tuple(mappings[k].name or k for k in columns)))
+        attrs['__keys__'] = keys
+        # 语句缓存：按查询形状保存已经转换好占位符的SQL，请求路径上只需查字典
+        attrs['__statements__'] = dict()
+        model = type.__new__(cls, name, bases, attrs)
+        model._compile_statements()
+        _register_model(model)
+        return model
 
 # 定义所有ORM映射的基类Model
 # 使既可以像字典那样通过[]访问key值（继承了字典类），也可以通过.访问key值（实现特殊方法__getattr__和__setattr__）
 # 通过ModelMetaclass元类来构造类
 class Model(dict, metaclass=ModelMetaclass):
 
+    # 子类设置__cache__ = True后，find/findAll/findNumber的结果会被缓存，写入该表时自动失效
+    __cache__ = False
+
+    # 子类设置__counters__后在内存里维护行数，findNumber('count(id)')不再扫描索引
+    # 如__counters__ = ('blog_id',)同时维护每个blog_id的行数，对应findNumber('count(id)', 'blog_id=?', [blog_id])
+    __counters__ = None
+
+    # 只查询了部分列的对象（见findAll的columns参数）会在实例上记录已加载的列名，完整对象为None
+    __loaded__ = None
+
+    # 从数据库加载或已保存的对象在实例上记录加载后被修改过的属性名，update()只写回这些列
+    # 直接构造的对象为None，update()写回所有列
+    __dirty__ = None
+
     # 这里调用了Model的父类dict的初始化方法
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
@@ -162,6 +1134,20 @@ class Model(dict, metaclass=ModelMetaclass):
     def __setattr__(self, key, value):
         self[key] = value
 
+    # 通过属性或[]赋值时记录修改过的属性，值没有变化的不算；dict的update()、pop()等方法不会被记录
+    def __setitem__(self, key, value):
+        dirty = self.__dirty__
+        if dirty is not None and (key not in self or self[key] != value):
+            dirty.add(key)
+        super(Model, self).__setitem__(key, value)
+
+    # 用数据库的行构造对象，此时没有修改过的属性
+    @classmethod
+    def _load(cls, row):
+        obj = cls(**row)
+        object.__setattr__(obj, '__dirty__', set())
+        return obj
+
     # #上面两个方法是用来获取和设置**kw转换而来的dict的值，而下面的getattr是用来获取当前实例的属性值
     def getValue(self, key):
         # 获取某个具体的值，肯定存在的情况下使用该函数,否则会使用__getattr()__
@@ -178,98 +1164,594 @@ class Model(dict, metaclass=ModelMetaclass):
                 setattr(self, key, value)
         return value
     
+    # 预编译固定形状的语句：按主键查找、插入、更新、删除，以及不带where的findAll
+    @classmethod
+    def _compile_statements(cls):
+        stmts = cls.__statements__
+        stmts['find'] = _driver_sql('%s where `%s`=?' % (cls.__select__, cls.__primary_key__))
+        stmts['insert'] = _driver_sql(cls.__insert__)
+        stmts['update'] = _driver_sql(cls.__update__)
+        stmts['delete'] = _driver_sql(cls.__delete__)
+        for limit in (None, 1, 2):
+            cls._findAllSql(None, None, limit)
+
+    # findAll的语句形状由where、orderBy、limit的形式（无、单个值、(offset, n)）和seek的形式决定
+    # where和orderBy都是代码里写死的字符串，用户输入只会出现在args里，所以形状的数量是有限的
+    # seek: None表示普通分页；1表示keyset分页的第一页；2表示keyset分页从某个游标之后继续
+    @classmethod
+    def _findAllSql(cls, where, orderBy, limit, seek=None, columns=None):
+        key = ('findAll', where, orderBy, limit, seek, columns)
+        sql = cls.__statements__.get(key)
+        if sql is None:
+            if columns:
+                L = ['select %s from `%s`' % (', '.join(map(lambda f: '`%s`' % f, columns)), cls.__table__)]
+            else:
+                L = [cls.__select__]
+            if seek:
+                # keyset分页按(排序列, 主键)定位，主键保证排序列相同时顺序也是确定的
+                column, op, direction = cls._seekColumn(orderBy)
+                if seek == 2:
+                    cond = '(`%s` %s ? or (`%s` = ? and `%s` %s ?))' % (column, op, column, cls.__primary_key__, op)
+                    where = '(%s) and %s' % (where, cond) if where else cond
+                orderBy = '`%s` %s, `%s` %s' % (column, direction, cls.__primary_key__, direction)
+            if where:
+                L.append('where')
+                L.append(where)
+            if orderBy:
+                L.append('order by')
+                L.append(orderBy)
+            # LIMIT 子句可以被用于指定 SELECT 语句返回的记录数（范围）
+            if limit == 1:
+                L.append('limit ?')
+            elif limit == 2:
+                L.append('limit ?, ?')
+            sql = cls.__statements__[key] = _driver_sql(' '.join(L))
+        return sql
+
+    # keyset分页只支持按单个列排序，如'created_at desc'，返回(列名, 比较符, 方向)
+    @classmethod
+    def _seekColumn(cls, orderBy):
+        L = (orderBy or '').replace('`', '').split()
+        if len(L) == 1:
+            L.append('asc')
+        if len(L) != 2 or L[1].lower() not in ('asc', 'desc') or (L[0] not in cls.__mappings__):
+            raise ValueError('Invalid orderBy value for seek: %s' % str(orderBy))
+        direction = L[1].lower()
+        return L[0], '<' if direction == 'desc' else '>', direction
+
+    # 查询部分列时，主键总是放在第一列，保证得到的部分对象仍然可以更新和删除
+    @classmethod
+    def _projection(cls, columns):
+        if columns is None:
+            return None
+        L = [cls.__primary_key__]
+        for name in columns:
+            if name not in cls.__mappings__:
+                raise ValueError('Invalid column name: %s' % name)
+            if name not in L:
+                L.append(name)
+        return tuple(L)
+
+    # 只查询部分列时的行类，按列名的组合缓存
+    @classmethod
+    def _rowClass(cls, columns):
+        key = ('row', columns)
+        row = cls.__statements__.get(key)
+        if row is None:
+            row = cls.__statements__[key] = _row_class('%sRow' % cls.__name__, columns)
+        return row
+
+    @classmethod
+    def defer(cls, *names):
+        '''
+        return all column names except names, for findAll(columns=...):
+        Blog.findAll(columns=Blog.defer('content'))
+        '''
+        for name in names:
+            if name not in cls.__fields__:
+                raise ValueError('Invalid column name: %s' % name)
+        return tuple(f for f in cls.__fields__ if f not in names)
+
+    # 只更新部分列的UPDATE语句，按列名的组合缓存
+    @classmethod
+    def _updateFieldsSql(cls, names):
+        key = ('update', names)
+        sql = cls.__statements__.get(key)
+        if sql is None:
+            sql = cls.__statements__[key] = _driver_sql('update `%s` set %s where `%s`=?' % (cls.__table__, ', '.join(map(lambda f: '`%s`=?' % (cls.__mappings__[f].name or f), names)), cls.__primary_key__))
+        return sql
+
+    # 多行INSERT：insert into `t` (...) values (?, ?), (?, ?)，按每批的行数缓存
+    @classmethod
+    def _insertManySql(cls, n):
+        key = ('insert', n)
+        sql = cls.__statements__.get(key)
+        if sql is None:
+            head, values = cls.__insert__.split(' values ')
+            sql = cls.__statements__[key] = _driver_sql('%s values %s' % (head, ', '.join([values] * n)))
+        return sql
+
+    # 插入的列名，与__insert__一样主键放在最后
+    @classmethod
+    def _insertColumns(cls):
+        return [cls.__mappings__[f].name or f for f in cls.__fields__] + [cls.__primary_key__]
+
+    @classmethod
+    def _insertIgnoreSql(cls):
+        sql = cls.__statements__.get('insert_ignore')
+        if sql is None:
+            sql = cls.__statements__['insert_ignore'] = _driver_sql(backend().insert_ignore_sql(cls.__table__, cls._insertColumns()))
+        return sql
+
+    # 主键冲突时更新names中的列，按names缓存
+    @classmethod
+    def _upsertSql(cls, names):
+        key = ('upsert', names)
+        sql = cls.__statements__.get(key)
+        if sql is None:
+            updates = [cls.__mappings__[f].name or f for f in names]
+            sql = cls.__statements__[key] = _driver_sql(backend().upsert_sql(cls.__table__, cls._insertColumns(), (cls.__primary_key__,), updates))
+        return sql
+
+    @classmethod
+    def _findManySql(cls, n):
+        key = ('findMany', n)
+        sql = cls.__statements__.get(key)
+        if sql is None:
+            sql = cls.__statements__[key] = _driver_sql('%s where `%s` in (%s)' % (cls.__select__, cls.__primary_key__, create_args_string(n)))
+        return sql
+
+    # delete from `t` where `pk` in (?, ?, ...)，按每批主键数量缓存
+    @classmethod
+    def _removeManySql(cls, n):
+        key = ('remove', n)
+        sql = cls.__statements__.get(key)
+        if sql is None:
+            sql = cls.__statements__[key] = _driver_sql('delete from `%s` where `%s` in (%s)' % (cls.__table__, cls.__primary_key__, create_args_string(n)))
+        return sql
+
+    @classmethod
+    def _removeWhereSql(cls, where):
+        key = ('removeWhere', where)
+        sql = cls.__statements__.get(key)
+        if sql is None:
+            sql = cls.__statements__[key] = _driver_sql('delete from `%s` where %s' % (cls.__table__, where))
+        return sql
+
+    @classmethod
+    def _updateWhereSql(cls, names, where):
+        key = ('updateWhere', names, where)
+        sql = cls.__statements__.get(key)
+        if sql is None:
+            for name in names:
+                if name not in cls.__fields__:
+                    raise ValueError('Invalid field name: %s' % name)
+            sql = cls.__statements__[key] = _driver_sql('update `%s` set %s where %s' % (cls.__table__, ', '.join(map(lambda f: '`%s`=?' % (cls.__mappings__[f].name or f), names)), where))
+        return sql
+
+    @classmethod
+    def _findNumberSql(cls, selectField, where):
+        key = ('findNumber', selectField, where)
+        sql = cls.__statements__.get(key)
+        if sql is None:
+            # 这里的 _num_ 为别名，任何客户端都可以按照这个名称引用这个列，就像它是个实际的列一样
+            L = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
+            if where:
+                L.append('where')
+                L.append(where)
+            sql = cls.__statements__[key] = _driver_sql(' '.join(L))
+        return sql
+
+    @classmethod
+    def create_table_sql(cls, if_not_exists=False):
+        '''
+        Return CREATE TABLE statement with primary key and declared indexes,
+        skipping an existing table if if_not_exists is True.
+        '''
+        columns = [(f.name or k, f.column_type) for k, f in cls.__mappings__.items()]
+        return backend().create_table_sql(cls.__table__, columns, cls.__primary_key__, cls.__keys__, if_not_exists)
+
+    @classmethod
+    async def check_indexes(cls):
+        '''
+        Compare declared indexes with the live table, return (missing, extra) as lists of (unique, columns).
+        '''
+        live = await backend().indexes(select, cls.__table__)
+        declared = set((unique, columns) for name, unique, columns in cls.__keys__)
+        return sorted(declared - live), sorted(live - declared)
+
     # classmethod这个装饰器是类方法的意思，即可以不创建实例直接调用类方法让，所有子类调用class方法
     # 表示参数cls被绑定到类的类型对象(在这里即为<class '__main__.User'> )而不是实例对象
     @classmethod
     async def find(cls, pk):
         ' find object by primary key. '
         # 之前已将数据库的select操作封装在了select函数中,传入了三个参数分别是 sql、args、size
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
-        if len(rs) == 0:
+        # 先查当前请求的identity map，命中就不用访问数据库
+        imap = _identity_map.get()
+        if imap is not None:
+            obj = imap.get(cls, pk)
+            if obj is not None:
+                return obj
+        if _transaction.get() is None and not _recently_written():
+            # 同一轮事件循环里对该Model的find合并成一条IN查询
+            # 多个协程等待同一个future，用shield()避免其中一个被取消时其他协程也被取消
+            row = await asyncio.shield(_loader_of(cls).load(pk))
+        else:
+            # 事务内必须使用固定的连接，不参与合并
+            # 会话最近写入过的要读主库，而合并的查询按第一个调用者的会话选择连接，也不参与合并
+            rs = await _select(cls.__statements__['find'], [pk], 1, cls.__cache__ and cls.__table__)
+            row = rs[0] if rs else None
+        if row is None:
             return None
-        # **表示关键字参数，将rs[0]即结果集合中的第一个（也是唯一一个）转换成关键字参数元组，rs[0]为dict
+        if imap is not None:
+            # 等待期间同一个请求里的其他协程可能已经加载了同一个对象
+            obj = imap.get(cls, pk)
+            if obj is not None:
+                return obj
+        # **表示关键字参数，将row转换成关键字参数元组，row为dict
         # 通过<class '__main__.User'>(位置参数元组)，产生一个实例对象
         # 注意,我们在select函数中,打开的是DictCursor,它会以dict的形式返回结果
-        return cls(**rs[0])
+        obj = cls._load(row)
+        if imap is not None:
+            imap.add(obj)
+        return obj
 
     @classmethod
-    async def findAll(cls, where=None, args=None, **kw):
-        sql = [cls.__select__]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        if args is None:
-            args = []
-        orderBy =  kw.get('orderBy', None)
-        if orderBy:
-            sql.append('order by')
-            sql.append(orderBy)
-        # LIMIT 子句可以被用于指定 SELECT 语句返回的记录数（范围）
-        limit = kw.get('limit', None)
-        if limit is not None:
-            sql.append('limit')
-            if isinstance(limit, int):
-                # 返回第x行
-                sql.append('?')
-                args.append(limit)
-            elif isinstance(limit, tuple) and len(limit) == 2:
-                # 返回第x到y行
-                sql.append('?, ?')
-                # extend() 函数用于在列表末尾一次性追加另一个序列中的多个值（用新列表扩展原来的列表）
-                args.extend(limit)
+    async def find_many(cls, pks):
+        '''
+        find objects by primary keys with IN (...) queries, return list in the order of pks, None if not found.
+        '''
+        pks = list(pks)
+        imap = _identity_map.get()
+        found = dict()
+        missing = []
+        for pk in pks:
+            if pk in found:
+                continue
+            obj = imap.get(cls, pk) if imap is not None else None
+            found[pk] = obj
+            if obj is None:
+                missing.append(pk)
+        if missing:
+            for row in await cls._findRows(missing):
+                obj = cls._load(row)
+                found[obj.getValue(cls.__primary_key__)] = obj
+                if imap is not None:
+                    imap.add(obj)
+        return [found.get(pk) for pk in pks]
+
+    # 按主键分批用IN查询，返回结果行（dict），pks中不应有重复的值
+    @classmethod
+    async def _findRows(cls, pks, batch_size=500):
+        if len(pks) == 1:
+            return (await _select(cls.__statements__['find'], pks, 1, cls.__cache__ and cls.__table__))
+        rows = []
+        for i in range(0, len(pks), batch_size):
+            chunk = pks[i:i + batch_size]
+            rows.extend(await _select(cls._findManySql(len(chunk)), chunk, None, cls.__cache__ and cls.__table__))
+        return rows
+
+    @classmethod
+    async def findAll(cls, where=None, args=None, orderBy=None, limit=None, after=None, columns=None, raw=False):
+        '''
+        find objects by where. Given after, use keyset pagination ordered by orderBy and primary key:
+        after=() for the first page, after=(value, pk) of the last object to get the next page.
+        Given columns, only select these columns (and primary key) and return partial objects.
+        Given raw=True, return read-only Row objects (see Row), which are not tracked by the identity map.
+        '''
+        columns = cls._projection(columns)
+        # 复制一份args，避免把limit的参数追加到调用者传入的list里
+        args = list(args) if args else []
+        seek = None
+        if after is not None:
+            # keyset分页直接用where定位到上一页最后一行之后，代价与页数无关，所以不能再带offset
+            if not isinstance(limit, int):
+                raise ValueError('Invalid limit value for seek: %s' % str(limit))
+            if len(after) == 0:
+                seek = 1
+            elif len(after) == 2:
+                seek = 2
+                args.extend((after[0], after[0], after[1]))
             else:
-                raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = await select(' '.join(sql), args)
-        return [cls(**r) for r in rs]
+                raise ValueError('Invalid after value: %s' % str(after))
+        if limit is None:
+            shape = None
+        elif isinstance(limit, int):
+            # 返回第x行
+            shape = 1
+            args.append(limit)
+        elif isinstance(limit, tuple) and len(limit) == 2:
+            # 返回第x到y行
+            shape = 2
+            # extend() 函数用于在列表末尾一次性追加另一个序列中的多个值（用新列表扩展原来的列表）
+            args.extend(limit)
+        else:
+            raise ValueError('Invalid limit value: %s' % str(limit))
+        sql = cls._findAllSql(where, orderBy, shape, seek, columns)
+        if raw:
+            # tuple游标返回的每一行直接按位置传给行类
+            row = cls.__row__ if columns is None else cls._rowClass(columns)
+            rs = await _select(sql, args, None, cls.__cache__ and cls.__table__, raw=True)
+            return [row(*r) for r in rs]
+        rs = await _select(sql, args, None, cls.__cache__ and cls.__table__)
+        if columns is None:
+            return [cls._load(r) for r in rs]
+        return [cls._partial(columns, r) for r in rs]
+
+    # 构造只加载了部分列的对象，__loaded__放在实例的__dict__里，不会出现在dict的内容中
+    @classmethod
+    def _partial(cls, columns, row):
+        obj = cls._load(row)
+        object.__setattr__(obj, '__loaded__', columns)
+        return obj
+
+    @classmethod
+    async def iter_all(cls, where=None, args=None, chunk_size=100, orderBy=None):
+        '''
+        iterate objects by where with a server side cursor, fetching chunk_size rows at a time:
+        async for comment in Comment.iter_all(): ...
+        '''
+        if chunk_size < 1:
+            raise ValueError('Invalid chunk_size value: %s' % str(chunk_size))
+        async for r in _iter_select(cls._findAllSql(where, orderBy, None), args, chunk_size):
+            yield cls._load(r)
 
     @classmethod
     async def findNumber(cls, selectField, where=None, args=None):
         # 根据WHERE条件查找，但返回的是整数，适用于select count(*)类型的SQL
         ' find number by select and where. '
-        # 这里的 _num_ 为别名，任何客户端都可以按照这个名称引用这个列，就像它是个实际的列一样
-        sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
-        # sql = ['select count(%s) _num_ from `%s`' % (selectField, cls.__table__)]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        rs = await select(' '.join(sql), args, 1)
+        key = None
+        if cls.__counters__ is not None and _transaction.get() is None:
+            key = cls._counterKey(selectField, where, args)
+            if key is not None:
+                num = _get_counter(key)
+                if num is not None:
+                    return num
+        rs = await _select(cls._findNumberSql(selectField, where), args, 1, cls.__cache__ and cls.__table__)
         if len(rs) == 0:
             return None
+        if key is not None:
+            _set_counter(key, rs[0]['_num_'])
         return rs[0]['_num_']
 
+    # 判断findNumber的查询能否用计数器回答，能则返回计数器的key：(表名,)或(表名, 列名, 值)
+    @classmethod
+    def _counterKey(cls, selectField, where, args):
+        shape = ('counter', selectField, where)
+        field = cls.__statements__.get(shape)
+        if field is None:
+            field = False
+            select = selectField.replace('`', '').replace(' ', '').lower()
+            if select in ('count(*)', 'count(1)', 'count(%s)' % cls.__primary_key__.lower()):
+                if not where:
+                    field = ''
+                else:
+                    cond = where.replace('`', '').replace(' ', '')
+                    for name in cls.__counters__:
+                        if cond == '%s=?' % name:
+                            field = name
+            cls.__statements__[shape] = field
+        if field is False:
+            return None
+        if field == '':
+            return (cls.__table__,)
+        return (cls.__table__, field, args[0])
+
     async def save(self):
         # 这个是实例方法
         # arg是保存所有Model实例属性和主键的list,使用getValueOrDefault方法的好处是保存默认值
         args = list(map(self.getValueOrDefault, self.__fields__))
         # 我们在定义__insert__时,将主键放在了末尾.因为属性与值要一一对应,因此通过append的方式将主键加在最后
         args.append(self.getValueOrDefault(self.__primary_key__))
-        rows = await execute(self.__insert__, args)
+        rows = await _execute(self.__statements__['insert'], args, table=self.__table__)
         if rows != 1:
             logging.warn('failed to insert record: affected rows: %s' % rows)
+        if self.__counters__ is not None:
+            _count_rows(self.__class__, [self], rows)
+        # 插入后的对象与数据库一致，之后的update()只写回修改过的列
+        object.__setattr__(self, '__dirty__', set())
+        imap = _identity_map.get()
+        if imap is not None:
+            imap.add(self)
+
+    async def insert_ignore(self):
+        '''
+        Insert the object unless a row with the same primary key or unique key exists,
+        return True if a row was inserted.
+        '''
+        args = list(map(self.getValueOrDefault, self.__fields__))
+        args.append(self.getValueOrDefault(self.__primary_key__))
+        rows = await _execute(self._insertIgnoreSql(), args, table=self.__table__)
+        if rows:
+            self._inserted(rows)
+        return rows > 0
+
+    async def upsert(self, update_fields=None):
+        '''
+        Insert the object, or update update_fields (default all fields) of the row with the same primary key,
+        return True if a row was inserted. Models with unique keys other than the primary key are not supported.
+        '''
+        # MySQL的on duplicate key update在任何唯一键冲突时都会更新，可能改到另一行（如email相同的其他用户），
+        # 而SQLite上只按主键更新，两种后端只在没有其他唯一键时一致
+        if any(unique for name, unique, columns in self.__keys__):
+            raise ValueError('upsert() does not support unique keys other than primary key: %s' % self.__table__)
+        if update_fields is None:
+            names = tuple(self.__fields__)
+        else:
+            names = tuple(update_fields)
+            for name in names:
+                if name not in self.__fields__:
+                    raise ValueError('Invalid field name: %s' % name)
+        if not names:
+            return (await self.insert_ignore())
+        if not backend().upsert_reports_insert:
+            # 从影响行数看不出是否插入，改为在一个事务里先insert ignore，没有插入再按主键更新
+            async with transaction():
+                if (await self.insert_ignore()):
+                    return True
+                args = list(map(self.getValue, names))
+                args.append(self.getValue(self.__primary_key__))
+                await _execute(self._updateFieldsSql(names), args, table=self.__table__)
+                self._upserted(names)
+                return False
+        args = list(map(self.getValueOrDefault, self.__fields__))
+        args.append(self.getValueOrDefault(self.__primary_key__))
+        rows = await _execute(self._upsertSql(names), args, table=self.__table__)
+        # MySQL的影响行数：插入为1，更新为2，已存在但值没有变化为0
+        if rows == 1:
+            self._inserted(rows)
+            return True
+        self._upserted(names)
+        return False
+
+    # 插入成功后维护计数、修改记录和identity map，与save()一致
+    def _inserted(self, rows):
+        if self.__counters__ is not None:
+            _count_rows(self.__class__, [self], rows)
+        object.__setattr__(self, '__dirty__', set())
+        imap = _identity_map.get()
+        if imap is not None:
+            imap.add(self)
+
+    # 更新了已有的行：该行未更新的列以数据库为准，当前对象不能代表它，从identity map里丢掉
+    def _upserted(self, names):
+        if self.__counters__ and not set(names).isdisjoint(self.__counters__):
+            _drop_counters(self.__table__, groups_only=True)
+        imap = _identity_map.get()
+        if imap is not None:
+            imap.discard(self.__class__, self.getValue(self.__primary_key__))
+
+    @classmethod
+    async def save_many(cls, objs, batch_size=100):
+        ' insert objects with multi-row INSERT statements in one transaction. '
+        if batch_size < 1:
+            raise ValueError('Invalid batch_size value: %s' % str(batch_size))
+        objs = list(objs)
+        batches = []
+        for i in range(0, len(objs), batch_size):
+            chunk = objs[i:i + batch_size]
+            args = []
+            for obj in chunk:
+                # 与save()一样，先填入默认值，主键放在每一行的最后
+                args.extend(map(obj.getValueOrDefault, cls.__fields__))
+                args.append(obj.getValueOrDefault(cls.__primary_key__))
+            batches.append((cls._insertManySql(len(chunk)), args))
+        if not batches:
+            return 0
+        rows = await _execute_batch(batches, cls.__table__)
+        if rows != len(objs):
+            logging.warn('failed to insert records: affected rows: %s, expected: %s' % (rows, len(objs)))
+        if cls.__counters__ is not None:
+            _count_rows(cls, objs, rows)
+        for obj in objs:
+            object.__setattr__(obj, '__dirty__', set())
+        imap = _identity_map.get()
+        if imap is not None:
+            for obj in objs:
+                imap.add(obj)
+        return rows
+
+    @classmethod
+    async def remove_where(cls, where, args=None):
+        ' remove rows by where. '
+        # 不允许没有条件的删除，避免误删整张表
+        if not where:
+            raise ValueError('Invalid where value: %s' % str(where))
+        rows = await _execute(cls._removeWhereSql(where), args or [], table=cls.__table__)
+        # 不知道具体影响了哪些行，丢掉计数，等下次查询或校正时重新计算
+        if cls.__counters__ is not None:
+            _drop_counters(cls.__table__)
+        _discard_model(cls)
+        return rows
+
+    @classmethod
+    async def remove_many(cls, pks, batch_size=500):
+        ' remove rows by primary keys with IN (...) chunks in one transaction. '
+        if batch_size < 1:
+            raise ValueError('Invalid batch_size value: %s' % str(batch_size))
+        pks = list(pks)
+        batches = []
+        for i in range(0, len(pks), batch_size):
+            chunk = pks[i:i + batch_size]
+            batches.append((cls._removeManySql(len(chunk)), chunk))
+        if not batches:
+            return 0
+        rows = await _execute_batch(batches, cls.__table__)
+        if cls.__counters__ is not None:
+            _drop_counters(cls.__table__)
+        imap = _identity_map.get()
+        if imap is not None:
+            for pk in pks:
+                imap.discard(cls, pk)
+        return rows
+
+    @classmethod
+    async def update_where(cls, set_fields, where, args=None):
+        ' update fields given by dict set_fields on rows by where. '
+        if not set_fields:
+            raise ValueError('Invalid set_fields value: %s' % str(set_fields))
+        if not where:
+            raise ValueError('Invalid where value: %s' % str(where))
+        names = tuple(set_fields.keys())
+        values = [set_fields[name] for name in names]
+        values.extend(args or [])
+        rows = await _execute(cls._updateWhereSql(names, where), values, table=cls.__table__)
+        # 不知道具体影响了哪些行，丢掉计数，等下次查询或校正时重新计算
+        if cls.__counters__ is not None:
+            _drop_counters(cls.__table__)
+        _discard_model(cls)
+        return rows
 
     async def update(self):
         # 只能更新此次给出的有新值的属性，因此不能使用getValueOrDefault方法
-        args = list(map(self.getValue, self.__fields__))
+        dirty = self.__dirty__
+        if dirty is not None:
+            # 只写回加载后修改过的列，按__fields__的顺序排列，同一组修改的列共用缓存的语句
+            # 部分对象（_partial()）也经过_load()，未加载的列（如content）不会被修改，保持数据库里的值
+            names = tuple(f for f in self.__fields__ if f in dirty)
+            if not names:
+                return
+            args = list(map(self.getValue, names))
+            sql = self._updateFieldsSql(names)
+        else:
+            args = list(map(self.getValue, self.__fields__))
+            sql = self.__statements__['update']
         args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        rows = await _execute(sql, args, table=self.__table__)
+        # 分组的列可能被修改，丢掉分组的计数，总数不变
+        if self.__counters__ and (dirty is None or not dirty.isdisjoint(self.__counters__)):
+            _drop_counters(self.__table__, groups_only=True)
+        if dirty is not None:
+            dirty.clear()
         if rows != 1:
             logging.warn('failed to update by primary key: affected rows: %s' % rows)
+        # 更新后以当前对象为准，替换掉identity map里同主键的旧对象
+        imap = _identity_map.get()
+        if imap is not None:
+            imap.add(self)
 
     async def remove(self):
         args = [self.getValue(self.__primary_key__)]
-        rows = await execute(self.__delete__, args)
+        rows = await _execute(self.__statements__['delete'], args, table=self.__table__)
         if rows != 1:
             logging.warn('failed to remove by primary key: affected rows: %s' % rows)
+        if self.__counters__ is not None:
+            _count_rows(self.__class__, [self], -rows)
+        imap = _identity_map.get()
+        if imap is not None:
+            imap.discard(self.__class__, args[0])
 
 # 属性的基类，给其他具体Model类继承，负责保存(数据库)表的一组字段名和字段类型  
 class Field(object):
 
-    # 表的字段包含名字、类型、是否为表的主键和默认值
-    def __init__(self, name, column_type, primary_key, default):
+    # 表的字段包含名字、类型、是否为表的主键和默认值，以及是否为该列建立普通索引或唯一索引
+    def __init__(self, name, column_type, primary_key, default, index=False, unique=False):
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        self.index = index
+        self.unique = unique
 
     # 返回表名字, 字段名:字段类型
     def __str__(self):
@@ -278,26 +1760,204 @@ class Field(object):
 class StringField(Field):
 
     # String一般不作为主键，所以默认False，DDL是数据定义语言，为了配合mysql，所以默认设定为100的长度
-    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)'):
-        super().__init__(name, ddl, primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)', index=False, unique=False):
+        super().__init__(name, ddl, primary_key, default, index, unique)
 
 class BooleanField(Field):
 
-    def __init__(self, name=None, default=False):
-        super().__init__(name, 'boolean', False, default)
+    def __init__(self, name=None, default=False, index=False):
+        super().__init__(name, 'boolean', False, default, index)
 
 class IntegerField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0):
-        super().__init__(name, 'biginit', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0, index=False, unique=False):
+        super().__init__(name, 'bigint', primary_key, default, index, unique)
 
 class FloatField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0.0):
-        super().__init__(name, 'real', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0.0, index=False, unique=False):
+        super().__init__(name, 'real', primary_key, default, index, unique)
 
 class TextField(Field):
 
     def __init__(self, name=None, default=None):
         # 这个是不能作为主键的对象，所以这里直接就设定成False了
         super().__init__(name, 'text', False, default)  
+
+# 计数器：在内存里维护每张表的行数以及按列分组的行数，findNumber('count(id)')直接返回，不用扫描索引
+# 计数随save/remove增减，批量操作或回滚后丢弃重算；计数持久化在counters表里，启动时加载，
+# 并由定时任务与数据库的真实行数校正，修正多进程部署、进程崩溃等造成的偏差
+class Counter(Model):
+    __table__ = 'counters'
+
+    name = StringField(primary_key=True, ddl='varchar(200)')
+    value = IntegerField()
+
+class RowCounters(object):
+    ' in memory row counts keyed by (table,) or (table, field, value). '
+
+    def __init__(self):
+        self._values = dict()
+        self._dirty = set()
+
+    def get(self, key):
+        return self._values.get(key)
+
+    def set(self, key, value):
+        self._values[key] = value
+        self._dirty.add(key)
+
+    def add(self, key, delta):
+        # 没有加载过的计数不用增减，下次查询时直接从数据库得到准确的值
+        value = self._values.get(key)
+        if value is not None:
+            self._values[key] = value + delta
+            self._dirty.add(key)
+
+    def drop(self, table, groups_only=False):
+        for key in [k for k in self._values if k[0] == table and (len(k) > 1 or not groups_only)]:
+            del self._values[key]
+            self._dirty.discard(key)
+
+    def keys(self):
+        return list(self._values.keys())
+
+    def pop_dirty(self):
+        dirty = [(key, self._values[key]) for key in self._dirty if key in self._values]
+        self._dirty.clear()
+        return dirty
+
+    def clear(self):
+        self._values.clear()
+        self._dirty.clear()
+
+__counters = RowCounters()
+__counters_task = None
+
+def _get_counter(key):
+    return __counters.get(key)
+
+def _set_counter(key, value):
+    __counters.set(key, value)
+
+def _drop_counters(table, groups_only=False):
+    __counters.drop(table, groups_only)
+
+# rows为实际插入（正数）或删除（负数）的行数，与对象个数不一致时说明有的没有成功，丢掉计数
+def _count_rows(cls, objs, rows):
+    if abs(rows) != len(objs):
+        _drop_counters(cls.__table__)
+        return
+    delta = 1 if rows > 0 else -1
+    __counters.add((cls.__table__,), rows)
+    for field in cls.__counters__:
+        for obj in objs:
+            value = obj.get(field)
+            if value is None and obj.__loaded__ is not None and field not in obj.__loaded__:
+                # 部分对象没有加载分组的列，不知道该减哪一组
+                _drop_counters(cls.__table__, groups_only=True)
+                return
+            __counters.add((cls.__table__, field, value), delta)
+
+# 计数器在counters表里的名字：表名，或者 表名.列名=值
+def _counter_name(key):
+    if len(key) == 1:
+        return key[0]
+    return '%s.%s=%s' % key
+
+def _counter_key(name):
+    table, dot, group = name.partition('.')
+    if not dot:
+        return (table,)
+    field, eq, value = group.partition('=')
+    return (table, field, value)
+
+async def load_counters():
+    '''
+    Load persisted counters of models with __counters__.
+    '''
+    n = 0
+    for c in await Counter.findAll():
+        key = _counter_key(c.name)
+        model = _model_of(key[0])
+        if model is None or model.__counters__ is None or (len(key) == 3 and key[1] not in model.__counters__):
+            continue
+        __counters.set(key, c.value)
+        n = n + 1
+    __counters.pop_dirty()
+    logging.info('load %s counters.' % n)
+
+async def flush_counters():
+    '''
+    Persist changed counters to the counters table.
+    '''
+    dirty = __counters.pop_dirty()
+    for i in range(0, len(dirty), 100):
+        chunk = dirty[i:i + 100]
+        args = []
+        for key, value in chunk:
+            args.append(_counter_name(key))
+            args.append(value)
+        await _execute(_driver_sql(__backend.upsert_sql(Counter.__table__, ('name', 'value'), ('name',), ('value',), len(chunk))), args)
+
+async def reconcile_counters():
+    '''
+    Recount loaded counters from the database to correct drift, then persist them.
+    '''
+    groups = dict()
+    for key in __counters.keys():
+        groups.setdefault(key[0], []).append(key)
+    for table, keys in groups.items():
+        model = _model_of(table)
+        pk = model.__primary_key__
+        # 在事务里读，保证读的是主库而不是有延迟的副本
+        async with transaction():
+            for key in keys:
+                if len(key) == 1:
+                    rs = await _select(_driver_sql('select count(`%s`) _num_ from `%s`' % (pk, table)), [], 1)
+                    _reconcile(key, rs[0]['_num_'])
+            by_field = dict()
+            for key in keys:
+                if len(key) == 3:
+                    by_field.setdefault(key[1], []).append(key[2])
+            for field, values in by_field.items():
+                for i in range(0, len(values), 100):
+                    chunk = values[i:i + 100]
+                    rs = await _select(_driver_sql('select `%s` _key_, count(`%s`) _num_ from `%s` where `%s` in (%s) group by `%s`' % (field, pk, table, field, create_args_string(len(chunk)), field)), chunk)
+                    found = dict((r['_key_'], r['_num_']) for r in rs)
+                    for value in chunk:
+                        _reconcile((table, field, value), found.get(value, 0))
+    await flush_counters()
+
+def _reconcile(key, value):
+    current = __counters.get(key)
+    if current is not None and current != value:
+        logging.warning('counter %s drifted: %s, actual: %s' % (_counter_name(key), current, value))
+        __counters.set(key, value)
+
+async def start_counters(interval=300.0):
+    '''
+    Load persisted counters and reconcile them with the database every interval seconds.
+    '''
+    global __counters_task
+    # 已有的数据库上可能还没有counters表，没有时先建立，相当于没有持久化的计数
+    for sql in Counter.create_table_sql(if_not_exists=True).split(';\n'):
+        await _execute(_driver_sql(sql.rstrip(';')), [])
+    await load_counters()
+    # 上次退出前或其他进程的写入可能没有持久化，加载后先校正一次再使用
+    await reconcile_counters()
+    async def run():
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await reconcile_counters()
+            except Exception as e:
+                logging.exception(e)
+    stop_counters()
+    __counters_task = asyncio.ensure_future(run())
+
+def stop_counters():
+    global __counters_task
+    if __counters_task is not None:
+        __counters_task.cancel()
+        __counters_task = None
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Generate schema DDL from models, or check declared indexes against the database.
+
+Usage:
+    python3 schema.py           print CREATE TABLE statements of all models for the configured backend
+    python3 schema.py --check   compare declared indexes with the live schema
+    python3 schema.py --create  create missing tables in the configured database, e.g. a sqlite file for load tests
+'''
+
+import sys, asyncio, logging
+
+import orm
+import models
+from config import configs
+
+def create_tables_sql():
+    orm.set_backend(configs.db.get('backend', 'mysql'))
+    return '\n\n'.join(m.create_table_sql() for m in orm.models())
+
+def _format_index(unique, columns):
+    return '%s(%s)' % ('unique ' if unique else '', ', '.join(columns))
+
+async def check_indexes(loop):
+    await orm.create_pool(loop=loop, **configs.db)
+    ok = True
+    try:
+        for m in orm.models():
+            missing, extra = await m.check_indexes()
+            for unique, columns in missing:
+                ok = False
+                print('%s: missing index %s' % (m.__table__, _format_index(unique, columns)))
+            for unique, columns in extra:
+                print('%s: undeclared index %s' % (m.__table__, _format_index(unique, columns)))
+    finally:
+        await orm.destroy_pool()
+    return ok
+
+async def create_tables(loop):
+    await orm.create_pool(loop=loop, **configs.db)
+    try:
+        for m in orm.models():
+            # 已经存在的表跳过，可以用来给已有的数据库补建新增的表
+            for sql in m.create_table_sql(if_not_exists=True).split(';\n'):
+                await orm.execute(sql.rstrip(';'), [])
+    finally:
+        await orm.destroy_pool()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    if len(sys.argv) > 1 and sys.argv[1] == '--check':
+        loop = asyncio.get_event_loop()
+        sys.exit(0 if loop.run_until_complete(check_indexes(loop)) else 1)
+    if len(sys.argv) > 1 and sys.argv[1] == '--create':
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(create_tables(loop))
+        sys.exit(0)
+    print(create_tables_sql())